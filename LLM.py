@@ -1,20 +1,189 @@
 import pandas as pd
-from dotenv import dotenv_values
-from openai import OpenAI
-from SourceRetriever import SourceRetriever
+from config import get_config
+from openai import AsyncOpenAI
+import httpx
+from SourceRetriever import SourceRetriever, count_tokens, CONTEXT_TOKEN_BUDGET
 import json
+import asyncio
 import re  # Import regular expressions for robust parsing
 import random
 import hashlib
+import sqlite3
+import time
+import threading
+import concurrent.futures
+import weakref
+from collections import OrderedDict
+
+try:
+    import h2  # noqa: F401 -- enables HTTP/2 support in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    # orjson is a faster drop-in for json.loads/dumps; its JSONDecodeError subclasses json.JSONDecodeError
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        # Same compact, sorted, UTF-8 output as orjson, so cache keys match with and without it
+        return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+try:
+    # json_repair fixes malformed model JSON with a single linear pass (no regex backtracking)
+    from json_repair import repair_json
+except ImportError:
+    repair_json = None
 
 # --- Configuration ---
-# Loads environment variables from the .env file.
 # Make sure your .env file contains the API_KEY for the LLM.
-config = dotenv_values(".env")
-LLM_API_KEY = config.get("API_KEY")
 LLM_API_URL = "https://api.helmholtz-blablador.fz-juelich.de/v1/"
 LLM_API_MODEL = "alias-large"
-SEED = config.get("SEED")
+
+# Local response cache for deterministic chat completions (opt-in via LLM(cache_path=CACHE_PATH)).
+CACHE_PATH = ".llm_cache.sqlite"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Number of summaries/answers kept in the in-memory cache (keyed on query and context),
+# opt-in via LLM(answer_cache_size=ANSWER_CACHE_SIZE).
+ANSWER_CACHE_SIZE = 512
+
+# Context longer than this (in characters, roughly 2000 tokens) is compressed
+# before it is sent to the summarizer/answerer (opt-in via LLM(compress_context=True)).
+COMPRESSION_THRESHOLD_CHARS = 8000
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_WORD_RE = re.compile(r'\w+')
+# Output token ceilings per call type (decoding dominates latency, so keep them tight)
+ANSWER_MAX_TOKENS = 250
+SUMMARY_MAX_TOKENS = 350
+REWRITE_MAX_TOKENS = 60
+QUERY_POOL_MAX_TOKENS = 400
+# Output tokens reserved per snippet for the relevant_indices list of answer_pipeline
+PIPELINE_TOKENS_PER_SNIPPET = 4
+# Maximum number of relevance filter requests in flight per filter_context call
+MAX_CONCURRENT_FILTER_REQUESTS = 8
+# Maximum number of snippets judged by the relevance filter in a single request
+FILTER_BATCH_SIZE = 40
+# Snippets are shortened to this many characters for the relevance filter only
+FILTER_SNIPPET_MAX_CHARS = 800
+# Number of (query, snippet) relevance decisions kept in memory, so overlapping contexts aren't judged twice
+# (only if the in-memory answer cache is enabled, see LLM(answer_cache_size=...))
+FILTER_CACHE_SIZE = 4096
+# Stop before the model starts echoing a new question or section
+STOP_SEQUENCES = ["\nQuestion:", "\n---"]
+_STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "what", "who", "how", "why", "when", "where",
+    "which", "does", "did", "is", "of", "in", "on", "to", "a", "an", "with", "that", "this",
+    "from", "about", "between", "versus", "their", "there", "its", "it", "be", "or", "by"
+}
+
+# --- Prompts ---
+# Static instructions live in the system prompt so every request starts with a
+# byte-identical prefix that providers can serve from their prompt cache.
+# All per-request data (context, question) goes into the trailing user message.
+REWRITE_SYSTEM_PROMPT = (
+    "You are an expert at rewriting user questions into high-quality search engine queries. "
+    "Convert the user question into a concise, keyword-focused query. "
+    "Only provide the rewritten query."
+)
+QUERY_POOL_SYSTEM_PROMPT = (
+    "You turn a user question into search engine queries.\n"
+    "1. Identify the CORE subjects of the question (the most important nouns, entities or concepts).\n"
+    "2. Combine RELEVANT core subjects into space-separated queries; a contextual term may be added.\n"
+    "3. Leave out junction words like 'and', 'or', 'but'.\n"
+    "Return ONLY a JSON object with this exact format:\n"
+    '{"queries": ["term1 term2", "term1 term2 term3", ...]}\n\n'
+    "Example: 'Is tomato sauce vegan?' -> "
+    '{"queries": ["tomato sauce ingredients", "tomato sauce vegan", "sauce ingredients vegan"]}'
+)
+QUERY_POOLS_SYSTEM_PROMPT = QUERY_POOL_SYSTEM_PROMPT + (
+    "\n\nYou will receive SEVERAL numbered user questions. Apply the instructions above to each of them and "
+    "return ONLY a valid JSON object with one list of queries per question, in the same order:\n"
+    '{"pools": [["question 1 term1 term2", ...], ["question 2 term1 term2", ...], ...]}'
+)
+SUMMARIZE_SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Your task is to synthesize the provided, fragmented "
+    "context snippets into a single, short, coherent paragraph. Focus only on the facts "
+    "presented in the context that are relevant to the user's question.\n\n"
+    "Please summarize the key information in the context snippets regarding the question."
+)
+ANSWER_FROM_SUMMARY_SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Your task is to provide a clear and direct answer in max. 5 sentences "
+    "to the user's question using ONLY the provided summary.\n\n"
+    "Based on the summary, please answer the question."
+)
+ANSWER_FROM_CONTEXT_SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Your task is to provide a clear and direct answer in max. 5 sentences.\n\n"
+    "Based on the context snippets, please answer the question.\n\n"
+    "Do NOT use any information that is not found in the context snippets provided.\n\n"
+    "If you cannot find the answer in the context snippets, please say so."
+)
+ANSWER_PIPELINE_SYSTEM_PROMPT = (
+    "You are a helpful AI assistant answering questions from numbered context snippets. Work in three steps:\n"
+    "1. Select the snippets that are relevant to the question. Be INCLUSIVE - only leave out snippets that are "
+    "completely unrelated to the question topic.\n"
+    "2. Synthesize the relevant snippets into a single, short, coherent summary paragraph.\n"
+    "3. Based on the summary, provide a clear and direct answer to the question in max. 5 sentences. "
+    "Do NOT use any information that is not found in the snippets; if they do not contain the answer, say so.\n\n"
+    "Return ONLY a JSON object with this exact format:\n"
+    '{"relevant_indices": [0, 2], "summary": "...", "answer": "..."}'
+)
+FILTER_SYSTEM_PROMPT = (
+    "You judge which numbered context snippets are relevant to answering the user's question. Be INCLUSIVE: "
+    "keep snippets that answer the question, contain related facts, examples or background, or mention the same "
+    "entities or topics. Only exclude snippets that are completely unrelated to the question topic; when in doubt, "
+    "include the snippet.\n"
+    "Return ONLY a JSON object with a 'relevant_indices' key containing the list of indices of the relevant "
+    "snippets (an empty list if none are relevant), e.g. {\"relevant_indices\": [0, 2, 4]}"
+)
+# Prebuilt system messages, sent byte-identical with every request
+_REWRITE_SYSTEM_MESSAGE = {"role": "system", "content": REWRITE_SYSTEM_PROMPT}
+_QUERY_POOL_SYSTEM_MESSAGE = {"role": "system", "content": QUERY_POOL_SYSTEM_PROMPT}
+_QUERY_POOLS_SYSTEM_MESSAGE = {"role": "system", "content": QUERY_POOLS_SYSTEM_PROMPT}
+_SUMMARIZE_SYSTEM_MESSAGE = {"role": "system", "content": SUMMARIZE_SYSTEM_PROMPT}
+_ANSWER_FROM_SUMMARY_SYSTEM_MESSAGE = {"role": "system", "content": ANSWER_FROM_SUMMARY_SYSTEM_PROMPT}
+_ANSWER_FROM_CONTEXT_SYSTEM_MESSAGE = {"role": "system", "content": ANSWER_FROM_CONTEXT_SYSTEM_PROMPT}
+_ANSWER_PIPELINE_SYSTEM_MESSAGE = {"role": "system", "content": ANSWER_PIPELINE_SYSTEM_PROMPT}
+_FILTER_SYSTEM_MESSAGE = {"role": "system", "content": FILTER_SYSTEM_PROMPT}
+# Structured output schema enforced server-side for the query pool
+QUERY_POOL_SCHEMA = {
+    "name": "query_pool",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "queries": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["queries"]
+    }
+}
+# Structured output schema for the combined query pools of several questions
+QUERY_POOLS_SCHEMA = {
+    "name": "query_pools",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "pools": {"type": "array", "items": {"type": "array", "items": {"type": "string"}}}
+        },
+        "required": ["pools"]
+    }
+}
+# Structured output schema enforced server-side for the relevance filter
+FILTER_SCHEMA = {
+    "name": "relevance",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "relevant_indices": {"type": "array", "items": {"type": "integer"}}
+        },
+        "required": ["relevant_indices"]
+    }
+}
 
 
 class LLM:
@@ -23,91 +192,177 @@ class LLM:
     It can rewrite queries, summarize context, and generate final answers.
     """
 
-    def __init__(self, api_key: str, base_url: str, model: str):
+    # Clients are shared per (api_key, base_url), so all instances use one connection pool
+    _shared_clients = {}
+    # One background event loop runs all LLM I/O; the shared async clients are bound to it
+    _loop = None
+    _loop_lock = threading.Lock()
+
+    def __init__(self, api_key: str, base_url: str, model: str, cache_path: str = None,
+                 temperature: float = 0.0, seed: int = 42, answer_cache_size: int = 0,
+                 compress_context: bool = False):
         """
-        Initializes the OpenAI client for the LLM.
+        Initializes the OpenAI client for the LLM and, if a cache_path is given, the local response cache.
+        With answer_cache_size > 0, up to that many summaries/answers are memoized in memory.
+        With compress_context, contexts longer than COMPRESSION_THRESHOLD_CHARS are compressed before prompting.
+        Requests use the given temperature and seed unless a call overrides them, so
+        identical requests produce reproducible (and therefore cacheable) completions.
         """
         self.model = model
+        self.loop = LLM._background_loop()
+        self.temperature = temperature
+        self.seed = seed
+        # Contexts with at most this many snippets are not worth an LLM filtering round-trip
+        self.min_filter_size = 8
+        self.compress_context = compress_context
+        # Cleared once the endpoint rejects response_format json_schema (see _json_chat)
+        self.json_schema_supported = True
         self.client = None
+        self.cache = None
+        # In-memory LRU of summaries/answers, checked before any prompt is built (off if the size is 0)
+        self.answer_cache_size = answer_cache_size
+        self._answer_cache = OrderedDict()
+        # In-memory LRU of relevance decisions per (normalized query, snippet hash), on with the answer cache
+        self._filter_cache = OrderedDict()
+        # Joined context text per live DataFrame (keyed on id(); entries are dropped when the frame is collected)
+        self._context_text_cache = {}
+        if cache_path:
+            # The cache is only ever used from the event loop thread, but it is created here.
+            self.cache = sqlite3.connect(cache_path, check_same_thread=False)
+            self.cache.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT, created_at REAL)"
+            )
+            self.cache.commit()
+        api_key = api_key or get_config().get("API_KEY")
         if not api_key:
             print("❌ LLM API_KEY not found in .env file.")
             return
 
-        print("Initializing LLM client...")
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        print("✅ LLM client initialized successfully.")
+        client_key = (api_key, base_url)
+        created = client_key not in LLM._shared_clients
+        if created:
+            print("Initializing LLM client...")
+            if not HTTP2_AVAILABLE:
+                print("⚠️ 'h2' is not installed, concurrent LLM requests fall back to HTTP/1.1 (pip install 'httpx[http2]').")
+            # One pooled (HTTP/2 if available) connection set with keep-alive, shared by all requests.
+            # Idle connections are kept for 3 minutes so pauses between user queries don't cost a new TLS handshake.
+            transport = httpx.AsyncHTTPTransport(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=180.0),
+                retries=2
+            )
+            http_client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(60.0, connect=5.0))
+            LLM._shared_clients[client_key] = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            print("✅ LLM client initialized successfully.")
+        self.client = LLM._shared_clients[client_key]
+        self._client_key = client_key
+        if created:
+            # Fire-and-forget: open the connection before the first real request.
+            # Later instances reuse the client and its already open connection.
+            self.submit(self.warmup())
+
+    @classmethod
+    def _background_loop(cls) -> asyncio.AbstractEventLoop:
+        """
+        Returns the shared background event loop, starting it on a daemon thread on first use.
+        """
+        with cls._loop_lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                threading.Thread(target=cls._loop.run_forever, name="llm-event-loop", daemon=True).start()
+        return cls._loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+        Schedules a coroutine on the background event loop and returns a concurrent.futures.Future.
+        All calls of the async methods of this class must go through this loop (or run on it).
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the background event loop and blocks until its result is available.
+        """
+        return self.submit(coro).result()
+
+    async def warmup(self):
+        """
+        Opens a connection to the LLM endpoint ahead of the first real request, so DNS, TCP and
+        TLS setup are off the critical path. Must run on the event loop that later uses the client.
+        """
+        if not self.client:
+            return
+        try:
+            await self.client.models.list()
+            print("✅ LLM connection warmed up.")
+        except Exception as e:
+            print(f"⚠️ LLM connection warm-up failed: {e}")
+
+    async def close(self):
+        """
+        Closes the HTTP connection pool and the response cache.
+        The pool is shared, so this affects every instance using the same API key and URL.
+        """
+        if self.client:
+            LLM._shared_clients.pop(self._client_key, None)
+            await self.client.close()
+        if self.cache:
+            self.cache.close()
 
-    def generate_query_pool(self, query: str, num_queries: int = 4) -> list:
+    async def generate_query_pool(self, query: str, num_queries: int = 4, diverse: bool = False) -> list:
         """
         Generates a pool of related search queries from the user's initial question.
+        With diverse=True the queries are sampled at a higher temperature and not cached.
         """
         if not self.client:
             print("Cannot generate query pool: Client not initialized.")
             return [query]
 
         print(f"\n--- Generating a pool of {num_queries} queries for: '{query}' ---")
-        system_prompt = (
-           "You are a specialized AI assistant for generating search queries. "
-           "Your task is to extract CORE subjects from the user's question and create search queries with space-separated subjects.\n\n"
-           "Instructions:\n"
-           "1. Remember the initial user question\n"
-           "2. Identify the CORE subjects (most important nouns, entities, or concepts) from the question\n"
-           "3. Create query combinations using space-separated words between RELEVANT CORE subjects\n"
-           "5. Remove junction words like 'and', 'or', 'but'\n"
-           "6. Focus on meaningful term combinations that would find relevant information\n"
-           "Return ONLY a valid JSON object with this exact format:\n"
-           '{"queries": ["term1 term2", "term1 term2 term3", ...]}\n\n'
-           "Example:\n"
-           "Input: 'Who is Naruto's son?'\n"
-           "Core subjects: Naruto (main core), son\n"
-           "Output: "
-           '{"queries": ["Naruto son"]}\n\n'
-           "Another example:\n"
-           "Input: 'What are the benefits of solar energy?'\n"
-           "Core subjects: solar, energy (main core), benefits\n"
-           "Output: "
-           '{"queries": ["solar energy benefits", "benefits solar energy"]}\n\n'
-           "Example with names:\n"
-           "Input: 'What did Sam Altman say about AI?'\n"
-           "Core subjects: Sam, Altman (main core), AI\n"
-           "Output: "
-           '{"queries": ["Sam Altman AI", "Sam Altman", "Altman AI"]}\n\n'
-           "Example with contextual addition:\n"
-           "Input: 'Is tomato sauce vegan?'\n"
-           "Core subjects: tomato, sauce (main core) + contextual: ingredients, vegan\n"
-           "Output: "
-           '{"queries": ["tomato sauce ingredients", "tomato sauce vegan", "sauce ingredients vegan"]}\n\n'
-           "Focus on creating search queries that combine individual words with spaces to find precise, relevant information."
-           "I HAVE TO RETURN A JSON  I HAVE TO RETURN A JSON I HAVE TO RETURN A JSON"
-        )
         user_prompt = f"User question: \"{query}\""
 
+        messages = [
+            _QUERY_POOL_SYSTEM_MESSAGE,
+            {"role": "user", "content": user_prompt}
+        ]
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0.7,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
-
-            response_content = response.choices[0].message.content
+            if diverse:
+                response_content = await self._json_chat(
+                    self._chat_content,
+                    messages,
+                    QUERY_POOL_SCHEMA,
+                    temperature=0.7,
+                    max_tokens=QUERY_POOL_MAX_TOKENS
+                )
+            else:
+                response_content = await self._json_chat(
+                    self._cached_chat,
+                    messages,
+                    QUERY_POOL_SCHEMA,
+                    max_tokens=QUERY_POOL_MAX_TOKENS
+                )
             query_list = [query]  # Default to original query
 
             try:
                 # First attempt: direct parsing
-                response_data = json.loads(response_content)
+                response_data = _json_loads(response_content)
                 query_list = response_data.get("queries", [query])
             except json.JSONDecodeError:
-                # Second attempt (self-correction): find JSON within the string
+                # Second attempt (self-correction): repair the JSON, or find it within the string
                 print("⚠️ LLM did not return valid JSON. Attempting to repair...")
-                match = re.search(r'\{.*}', response_content, re.DOTALL)
-                if match:
-                    json_str = match.group(0)
+                if repair_json:
                     try:
-                        response_data = json.loads(json_str)
+                        response_data = _json_loads(repair_json(response_content))
+                        query_list = response_data.get("queries", [query])
+                        print("✅ Successfully repaired and parsed JSON from response.")
+                    except (json.JSONDecodeError, AttributeError):
+                        print("❌ Repair failed. Could not parse repaired JSON.")
+                elif (start := response_content.find("{")) != -1 and (end := response_content.rfind("}")) > start:
+                    # Outermost {...} span, found in linear time (a DOTALL regex can backtrack quadratically)
+                    json_str = response_content[start:end + 1]
+                    try:
+                        response_data = _json_loads(json_str)
                         query_list = response_data.get("queries", [query])
                         print("✅ Successfully repaired and parsed JSON from response.")
                     except json.JSONDecodeError:
@@ -115,6 +370,7 @@ class LLM:
                 else:
                     print("❌ Repair failed. No JSON object found in the response.")
 
+            query_list = self._dedupe_queries(query_list, query)
             print(f"✅ Generated query pool: {query_list}")
             return query_list
 
@@ -122,7 +378,54 @@ class LLM:
             print(f"❌ An unexpected error occurred while generating the query pool: {e}")
             return [query]
 
-    def rewrite_query(self, query: str) -> str:
+    def _dedupe_queries(self, query_list: list, query: str) -> list:
+        """
+        Drops reformulations that only differ in case, punctuation or word order
+        (both the OR and the AND retrieval treat a query as a bag of words).
+        Falls back to the original query if nothing is left.
+        """
+        seen = set()
+        unique_queries = []
+        for q in query_list:
+            normalized = tuple(sorted(_WORD_RE.findall(str(q).lower())))
+            if normalized and normalized not in seen:
+                seen.add(normalized)
+                unique_queries.append(q)
+        return unique_queries or [query]
+
+    async def generate_query_pools(self, queries: list) -> list:
+        """
+        Generates the query pools for several user questions with a single LLM request.
+        Falls back to one generate_query_pool call per question if the response cannot be parsed.
+        Returns one query pool per question, in the same order.
+        """
+        if not self.client:
+            print("Cannot generate query pools: Client not initialized.")
+            return [[query] for query in queries]
+        if len(queries) <= 1:
+            return [await self.generate_query_pool(query) for query in queries]
+
+        print(f"\n--- Generating query pools for {len(queries)} questions in one request ---")
+        user_prompt = "\n".join(f"{i}. User question: \"{query}\"" for i, query in enumerate(queries, 1))
+        try:
+            response_content = await self._json_chat(
+                self._cached_chat,
+                [_QUERY_POOLS_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}],
+                QUERY_POOLS_SCHEMA,
+                max_tokens=QUERY_POOL_MAX_TOKENS * len(queries)
+            )
+            pools = _json_loads(response_content).get("pools")
+            if isinstance(pools, list) and len(pools) == len(queries) and all(isinstance(p, list) for p in pools):
+                pools = [self._dedupe_queries(pool, query) for pool, query in zip(pools, queries)]
+                print(f"✅ Generated {len(pools)} query pools")
+                return pools
+            print("⚠️ Combined query pool response did not match the questions. Falling back to one request per question...")
+        except Exception as e:
+            print(f"⚠️ Could not generate the query pools in one request ({e}). Falling back to one request per question...")
+
+        return list(await asyncio.gather(*[self.generate_query_pool(query) for query in queries]))
+
+    async def rewrite_query(self, query: str) -> str:
         """
         Uses the LLM to rewrite the user's query into a more optimal form for a search engine.
         """
@@ -130,26 +433,228 @@ class LLM:
             return query
 
         print(f"\n--- Rewriting query: '{query}' ---")
-        system_prompt = (
-            "You are an expert at rewriting user questions into high-quality search engine queries. "
-            "Convert the user question into a concise, keyword-focused query. "
-            "Only provide the rewritten query."
-        )
         user_prompt = f"User question: \"{query}\""
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0.0,
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+            response_content = await self._cached_chat(
+                [_REWRITE_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}],
+                max_tokens=REWRITE_MAX_TOKENS
             )
-            rewritten = response.choices[0].message.content.strip().replace("\"", "")
+            rewritten = response_content.strip().replace("\"", "")
             print(f"✅ Rewritten query: '{rewritten}'")
             return rewritten
         except Exception as e:
             print(f"❌ An error occurred while rewriting the query: {e}")
             return query
 
-    def summarize_context(self, context_df: pd.DataFrame, query: str) -> str:
+    async def _chat_content(self, messages: list, **params) -> str:
+        """
+        Sends an uncached chat completion request over the shared client and returns the message content.
+        The raw response body is decoded directly, which skips building the SDK's response models
+        on the high-volume paths (relevance filtering, sampled query pools).
+        """
+        response = await self.client.chat.completions.with_raw_response.create(
+            model=self.model, messages=messages, **params
+        )
+        return _json_loads(response.http_response.content)["choices"][0]["message"]["content"]
+
+    async def _json_chat(self, send, messages: list, schema: dict, **params) -> str:
+        """
+        Requests a JSON response through send (_chat_content or _cached_chat), constrained to the schema
+        with response_format json_schema. If the request is rejected, it is retried once in json_object
+        mode (the prompts spell out the expected keys). Only if the error is about the response format
+        itself is json_object used for all further requests.
+        """
+        if self.json_schema_supported:
+            try:
+                return await send(messages, response_format={"type": "json_schema", "json_schema": schema}, **params)
+            except Exception as e:
+                if getattr(e, "status_code", None) not in (400, 422):
+                    raise
+                error_text = f"{e} {getattr(e, 'body', '')}".lower()
+                format_rejected = "response_format" in error_text or "json_schema" in error_text
+                print(f"⚠️ json_schema request rejected ({e}). Retrying with json_object...")
+            content = await send(messages, response_format={"type": "json_object"}, **params)
+            if format_rejected:
+                self.json_schema_supported = False
+            return content
+        return await send(messages, response_format={"type": "json_object"}, **params)
+
+    async def _cached_chat(self, messages: list, temperature: float = None, **kwargs) -> str:
+        """
+        Sends a chat completion request, answering repeated identical requests from the local cache.
+        Uses the instance temperature and seed unless they are passed explicitly.
+        Returns the raw message content of the response.
+        """
+        if temperature is None:
+            temperature = self.temperature
+        kwargs.setdefault("seed", self.seed)
+        key = hashlib.sha256(
+            _json_dumps([self.model, temperature, messages, kwargs])
+        ).hexdigest()
+
+        if self.cache:
+            row = self.cache.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at > ?",
+                (key, time.time() - CACHE_TTL_SECONDS)
+            ).fetchone()
+            if row:
+                print("✅ Response served from cache.")
+                return row[0]
+
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            temperature=temperature,
+            messages=messages,
+            **kwargs
+        )
+        content = response.choices[0].message.content
+
+        # Report provider-side prompt cache hits when the endpoint exposes them
+        details = getattr(response.usage, "prompt_tokens_details", None) if response.usage else None
+        cached_tokens = getattr(details, "cached_tokens", None) if details else None
+        if cached_tokens:
+            print(f"✅ {cached_tokens}/{response.usage.prompt_tokens} prompt tokens served from provider cache.")
+
+        if self.cache and content:
+            self.cache.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                (key, content, time.time())
+            )
+            self.cache.commit()
+        return content
+
+    async def _stream_deltas(self, messages: list, temperature: float, **kwargs):
+        """
+        Streams a chat completion and yields the text deltas as they arrive.
+        The answer length is bounded by the prompt and max_tokens.
+        """
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            temperature=temperature,
+            messages=messages,
+            stream=True,
+            **kwargs
+        )
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            yield chunk.choices[0].delta.content
+
+    def _compress_snippets(self, texts: list, query: str) -> list:
+        """
+        Question-guided compression of the context snippets. Keeps only the sentences of each
+        snippet that share a content word with the query (or its first sentence if none do).
+        """
+        query_terms = {w for w in _WORD_RE.findall(query.lower()) if w not in _STOPWORDS}
+        compressed = []
+        for text in texts:
+            sentences = _SENTENCE_SPLIT_RE.split(text.strip())
+            kept = [s for s in sentences if query_terms & set(_WORD_RE.findall(s.lower()))]
+            compressed.append(" ".join(kept) if kept else sentences[0])
+
+        print(f"✅ Context compressed: {sum(len(t) for t in texts)} → {sum(len(t) for t in compressed)} characters")
+        return compressed
+
+    def _compact(self, text: str, max_chars: int = FILTER_SNIPPET_MAX_CHARS) -> str:
+        """
+        Shortens a snippet to its beginning and end, which is enough to judge its relevance.
+        """
+        if len(text) <= max_chars:
+            return text
+        half = max_chars // 2
+        return f"{text[:half]} […] {text[-half:]}"
+
+    def build_context_text(self, context_df: pd.DataFrame, query: str) -> str:
+        """
+        Joins the context snippets into one bullet-separated string for the prompt.
+        If compress_context is set, contexts longer than COMPRESSION_THRESHOLD_CHARS are compressed first.
+        The result is cached per DataFrame, so summarizing and answering from the same
+        context only join (and compress) it once. Context DataFrames are not modified in place.
+        """
+        cached = self._context_text_cache.get(id(context_df))
+        if cached and cached[0] in (None, query):
+            return cached[1]
+
+        texts = context_df['text']
+        if not self.compress_context or texts.str.len().sum() <= COMPRESSION_THRESHOLD_CHARS:
+            # Short (or uncompressed) contexts are joined as they are, independent of the query
+            query_key, context_text = None, texts.str.cat(sep="\n- ")
+        else:
+            query_key, context_text = query, "\n- ".join(self._compress_snippets(texts.tolist(), query))
+
+        if id(context_df) not in self._context_text_cache:
+            weakref.finalize(context_df, self._context_text_cache.pop, id(context_df), None)
+        self._context_text_cache[id(context_df)] = (query_key, context_text)
+        return context_text
+
+    def _summarize_messages(self, context_text: str, query: str) -> list:
+        """
+        Builds the chat messages for summarizing the context.
+        """
+        user_prompt = (
+            f"Context Snippets:\n- {context_text}\n\n"
+            f"Question: {query}"
+        )
+        return [_SUMMARIZE_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}]
+
+    def _answer_from_summary_messages(self, summarized_context: str, query: str) -> list:
+        """
+        Builds the chat messages for answering the question from a summary.
+        """
+        user_prompt = (
+            f"Summary:\n{summarized_context}\n\n"
+            f"Question: {query}"
+        )
+        return [_ANSWER_FROM_SUMMARY_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}]
+
+    def _answer_from_context_messages(self, context_text: str, query: str, is_pipeline_4: bool = False) -> list:
+        """
+        Builds the chat messages for answering the question directly from the raw context.
+        """
+        user_prompt = (
+            f"Context Snippets:\n- {context_text}\n\n"
+            f"Question: {query}"
+        )
+
+        if is_pipeline_4:
+            # Create a hash from the query and seed to make the decision deterministic
+            seed = get_config().get("SEED")
+            hash_object = hashlib.sha256(f"{query}{seed}".encode())
+            hash_hex = hash_object.hexdigest()
+            # Use the hash to decide whether to append the seed (ensures consistency for the same query)
+            if int(hash_hex, 16) % 100 < 25:
+                user_prompt += f"\n{seed}"
+
+        return [_ANSWER_FROM_CONTEXT_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}]
+
+    def _answer_cache_key(self, kind: str, query: str, texts) -> tuple:
+        """
+        Builds the in-memory cache key from the normalized query and the (order-independent) context texts.
+        """
+        normalized_query = " ".join(query.lower().split())
+        context_hash = hashlib.sha1("\n".join(sorted(texts)).encode()).hexdigest()
+        return kind, hashlib.sha1(normalized_query.encode()).hexdigest(), context_hash
+
+    async def _memoized(self, key: tuple, generate) -> str:
+        """
+        Returns the cached result for the key, or awaits generate() and caches a non-empty result.
+        Without an answer cache, generate() is always awaited.
+        """
+        if not self.answer_cache_size:
+            return await generate()
+        if key in self._answer_cache:
+            self._answer_cache.move_to_end(key)
+            print("✅ Result served from in-memory cache.")
+            return self._answer_cache[key]
+
+        result = await generate()
+        if result:
+            self._answer_cache[key] = result
+            if len(self._answer_cache) > self.answer_cache_size:
+                self._answer_cache.popitem(last=False)
+        return result
+
+    async def summarize_context(self, context_df: pd.DataFrame, query: str) -> str:
         """
         Summarizes the retrieved context in relation to the original query.
         """
@@ -157,94 +662,225 @@ class LLM:
             return ""
 
         print(f"--- Summarizing context of size {len(context_df)} for query: '{query}' ---")
-        context_texts = "\n- ".join(context_df['text'].tolist())
-        system_prompt = (
-            "You are a helpful AI assistant. Your task is to synthesize the provided, fragmented "
-            "context snippets into a single, short, coherent paragraph. Focus only on the facts "
-            "presented in the context that are relevant to the user's question."
+        return await self._memoized(
+            self._answer_cache_key("summary", query, context_df['text']),
+            lambda: self._summarize_packed(self.build_context_text(context_df, query), query)
         )
-        user_prompt = (
-            f"Please summarize the key information in the following context regarding the question: '{query}'\n\n"
-            f"Context Snippets:\n- {context_texts}"
+
+    async def _summarize_packed(self, context_text: str, query: str) -> str:
+        """
+        Summarizes the context in one request if it fits into CONTEXT_TOKEN_BUDGET. Otherwise the
+        snippets are packed into groups that fit, the groups are summarized concurrently and the
+        partial summaries are merged with one more request.
+        """
+        if count_tokens([context_text])[0] <= CONTEXT_TOKEN_BUDGET:
+            return await self.summarize_context_from_text(context_text, query)
+
+        snippets = context_text.split("\n- ")
+        groups, group, group_tokens = [], [], 0
+        for snippet, tokens in zip(snippets, count_tokens(snippets)):
+            if group and group_tokens + tokens > CONTEXT_TOKEN_BUDGET:
+                groups.append(group)
+                group, group_tokens = [], 0
+            group.append(snippet)
+            group_tokens += tokens
+        groups.append(group)
+
+        print(f"--- Context exceeds {CONTEXT_TOKEN_BUDGET} tokens, summarizing it in {len(groups)} parts ---")
+        partial_summaries = await asyncio.gather(
+            *[self.summarize_context_from_text("\n- ".join(part), query) for part in groups]
         )
+        partial_summaries = [summary for summary in partial_summaries if summary]
+        if len(partial_summaries) <= 1:
+            return partial_summaries[0] if partial_summaries else ""
+        return await self.summarize_context_from_text("\n- ".join(partial_summaries), query)
+
+    async def summarize_context_from_text(self, context_text: str, query: str) -> str:
+        """
+        Summarizes an already joined context text (see build_context_text) in relation to the original query.
+        """
+        if not self.client or not context_text:
+            return ""
+
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0.2,
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+            response_content = await self._cached_chat(
+                self._summarize_messages(context_text, query),
+                max_tokens=SUMMARY_MAX_TOKENS,
+                stop=STOP_SEQUENCES
             )
-            return response.choices[0].message.content.strip()
+            return response_content.strip()
         except Exception as e:
             print(f"❌ An error occurred while generating the summary: {e}")
             return ""
 
-    def answer_question_from_summary(self, summarized_context: str, query: str) -> str:
+    async def answer_question_from_summary(self, summarized_context: str, query: str) -> str:
         """
         Generates a final answer from the summarized context.
         """
         if not self.client or not summarized_context:
             return ""
         print(f"--- Generating answer from summary for query: '{query}' ---")
-        system_prompt = (
-            "You are a helpful AI assistant. Your task is to provide a clear and direct answer in max. 5 sentences "
-            "to the user's question using ONLY the provided summary."
-        )
-        user_prompt = (
-            f"Based on the following summary, please answer the question.\n\n"
-            f"Summary:\n{summarized_context}\n\n"
-            f"Question: {query}"
+        return await self._memoized(
+            self._answer_cache_key("answer_from_summary", query, [summarized_context]),
+            lambda: self._answer_from_summary(summarized_context, query)
         )
+
+    async def _answer_from_summary(self, summarized_context: str, query: str) -> str:
+        """
+        Sends the request for answer_question_from_summary.
+        """
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0.1,
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+            response_content = await self._cached_chat(
+                self._answer_from_summary_messages(summarized_context, query),
+                max_tokens=ANSWER_MAX_TOKENS,
+                stop=STOP_SEQUENCES
             )
-            return response.choices[0].message.content.strip()
+            return response_content.strip()
         except Exception as e:
             print(f"❌ An error occurred while generating the answer from summary: {e}")
             return ""
 
-    def answer_question_from_context(self, context_df: pd.DataFrame, query: str, is_pipeline_4: bool = False) -> str:
+    async def answer_question_from_context(self, context_df: pd.DataFrame, query: str, is_pipeline_4: bool = False) -> str:
         """
         Generates a final answer directly from the raw context.
         """
         if not self.client or context_df.empty:
             return ""
         print(f"--- Generating answer from context of size {len(context_df)} for query: '{query}' ---")
-        context_texts = "\n- ".join(context_df['text'].tolist())
-        system_prompt = (
-            "You are a helpful AI assistant. Your task is to provide a clear and direct answer in max. 5 sentences."
+        return await self._memoized(
+            self._answer_cache_key(f"answer_from_context:{is_pipeline_4}", query, context_df['text']),
+            lambda: self.answer_question_from_context_text(
+                self.build_context_text(context_df, query), query, is_pipeline_4
+            )
         )
-        
+
+    async def answer_question_from_context_text(self, context_text: str, query: str, is_pipeline_4: bool = False) -> str:
+        """
+        Generates a final answer from an already joined context text (see build_context_text).
+        """
+        if not self.client or not context_text:
+            return ""
+        try:
+            response_content = await self._cached_chat(
+                self._answer_from_context_messages(context_text, query, is_pipeline_4),
+                max_tokens=ANSWER_MAX_TOKENS,
+                stop=STOP_SEQUENCES
+            )
+            return response_content.strip()
+        except Exception as e:
+            print(f"❌ An error occurred while generating the answer from context: {e}")
+            return ""
+
+    async def answer_pipeline(self, context_df: pd.DataFrame, query: str) -> dict:
+        """
+        Filters, summarizes and answers in a single LLM call instead of three sequential ones.
+        Opt-in alternative to filter_context/summarize_context/answer_question_from_summary; the apps
+        use the separate steps. The whole context is sent uncompressed, so it suits small contexts only.
+        Returns a dict with the 'filtered_context' DataFrame, the 'summary', the 'answer' and an
+        'error' message ("" on success).
+        """
+        result = {'filtered_context': context_df, 'summary': "", 'answer': "", 'error': ""}
+        if not self.client or context_df.empty:
+            return result
+
+        print(f"--- Filtering, summarizing and answering from context of size {len(context_df)} for query: '{query}' ---")
+        context_snippets = "\n".join(f"[{position}]: {text}" for position, text in enumerate(context_df['text']))
         user_prompt = (
-            f"Based on the following context snippets, please answer the question.\n\n"
-            f"Do NOT use any information that is not found in the context snippets provided.\n\n"
-            f"If you cannot find the answer in the context snippets, please say so.\n\n"
-            f"Context Snippets:\n- {context_texts}\n\n"
+            f"Context Snippets:\n{context_snippets}\n\n"
             f"Question: {query}"
         )
+        try:
+            response_content = await self._cached_chat(
+                [_ANSWER_PIPELINE_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}],
+                # The index list grows with the context, so it gets its own share of the output budget
+                max_tokens=SUMMARY_MAX_TOKENS + ANSWER_MAX_TOKENS + PIPELINE_TOKENS_PER_SNIPPET * len(context_df),
+                response_format={"type": "json_object"}
+            )
+            response_data = _json_loads(response_content)
+        except json.JSONDecodeError as e:
+            result['error'] = f"Could not parse the combined LLM response (possibly truncated): {e}"
+            print(f"❌ {result['error']}")
+            return result
+        except Exception as e:
+            result['error'] = f"An error occurred while running the combined answer pipeline: {e}"
+            print(f"❌ {result['error']}")
+            return result
+
+        relevant_indices = [
+            idx for idx in response_data.get('relevant_indices', [])
+            if isinstance(idx, int) and 0 <= idx < len(context_df)
+        ]
+        if relevant_indices:
+            result['filtered_context'] = context_df.iloc[relevant_indices].reset_index(drop=True)
+        result['summary'] = str(response_data.get('summary', "")).strip()
+        result['answer'] = str(response_data.get('answer', "")).strip()
+        print(f"✅ Combined answer generated from {len(result['filtered_context'])} relevant snippets")
+        return result
+
+    async def answer_question_from_summary_stream(self, summarized_context: str, query: str):
+        """
+        Streaming variant of answer_question_from_summary: yields the answer text as it is generated.
+        Streamed answers bypass the response caches.
+        """
+        if not self.client or not summarized_context:
+            return
+        print(f"--- Streaming answer from summary for query: '{query}' ---")
+        async for delta in self._stream_deltas(
+                self._answer_from_summary_messages(summarized_context, query),
+                self.temperature,
+                seed=self.seed,
+                max_tokens=ANSWER_MAX_TOKENS,
+                stop=STOP_SEQUENCES
+        ):
+            yield delta
+
+    async def answer_question_from_context_stream(self, context_df: pd.DataFrame, query: str, is_pipeline_4: bool = False):
+        """
+        Streaming variant of answer_question_from_context: yields the answer text as it is generated.
+        Streamed answers bypass the response caches.
+        """
+        if not self.client or context_df.empty:
+            return
+        print(f"--- Streaming answer from context of size {len(context_df)} for query: '{query}' ---")
+        async for delta in self._stream_deltas(
+                self._answer_from_context_messages(self.build_context_text(context_df, query), query, is_pipeline_4),
+                self.temperature,
+                seed=self.seed,
+                max_tokens=ANSWER_MAX_TOKENS,
+                stop=STOP_SEQUENCES
+        ):
+            yield delta
+
+    async def _filter_batch(self, batch_texts: list, query: str, batch_number: int) -> list:
+        """
+        Asks the LLM which snippets of one batch are relevant to the query.
+        Returns the positions of the relevant snippets within the batch, or None if the request or parsing fails.
+        """
+        context_batch = "\n".join(f"[{position}]: {self._compact(text)}" for position, text in enumerate(batch_texts))
 
-        if is_pipeline_4:
-            # Create a hash from the query and seed to make the decision deterministic
-            hash_object = hashlib.sha256(f"{query}{SEED}".encode())
-            hash_hex = hash_object.hexdigest()
-            # Use the hash to decide whether to append the seed (ensures consistency for the same query)
-            if int(hash_hex, 16) % 100 < 25:
-                user_prompt += f"\n{SEED}"
+        user_prompt = (
+            f"Context snippets:\n{context_batch}\n\n"
+            f"Question: {query}"
+        )
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0.1,
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+            response_content = await self._json_chat(
+                self._chat_content,
+                [_FILTER_SYSTEM_MESSAGE, {"role": "user", "content": user_prompt}],
+                FILTER_SCHEMA,
+                temperature=self.temperature,
+                seed=self.seed
             )
-            return response.choices[0].message.content.strip()
+
+            relevant_indices = _json_loads(response_content)["relevant_indices"]
+            # Keep the relevant snippets of this batch
+            return [idx for idx in relevant_indices if 0 <= idx < len(batch_texts)]
+
         except Exception as e:
-            print(f"❌ An error occurred while generating the answer from context: {e}")
-            return ""
+            print(f"❌ Error occurred while filtering context batch {batch_number}: {e}")
+            return None
 
-    def filter_context(self, context_df: pd.DataFrame, query: str) -> pd.DataFrame:
+    async def filter_context(self, context_df: pd.DataFrame, query: str) -> pd.DataFrame:
         """
         Filters the context by removing snippets that are not relevant to the user's query.
         Uses the LLM to evaluate each context snippet for relevance.
@@ -252,81 +888,77 @@ class LLM:
         """
         if not self.client or context_df.empty:
             return context_df
+        if len(context_df) <= self.min_filter_size:
+            print(f"--- Skipping filtering for small context of size {len(context_df)} ---")
+            return context_df
 
         print(f"--- Filtering context of size {len(context_df)} for query: '{query}' ---")
 
-        filtered_contexts = []
-
-        # Process contexts in batches to avoid token limits
-        batch_size = 5
-        for i in range(0, len(context_df), batch_size):
-            batch = context_df.iloc[i:i + batch_size]
-            batch_texts = []
-            for idx, row in batch.iterrows():
-                batch_texts.append(f"[{idx}]: {row['text']}")
-
-            context_batch = "\n".join(batch_texts)
-
-            system_prompt = (
-                "You are an expert at evaluating text relevance for question-answering systems. Your task is to determine which context snippets "
-                "are relevant to answering the user's question. Be INCLUSIVE rather than strict - it's better to include potentially useful information.\n\n"
-                "Evaluation criteria (be GENEROUS in your assessment):\n"
-                "- Include snippets that directly answer the question or provide key information\n"
-                "- Include snippets with relevant facts, data, or examples related to the topic\n"
-                "- Include snippets that provide background context or related information\n"
-                "- Include snippets that mention the same entities, concepts, or topics\n"
-                "- Include snippets that could provide partial answers or supporting information\n"
-                "- Only exclude snippets that are completely unrelated to the question topic\n"
-                "- When in doubt, INCLUDE the snippet rather than exclude it\n\n"
-                "Return ONLY a JSON object with a 'relevant_indices' key containing a list of indices (numbers) of the relevant snippets. "
-                "If NO snippets are relevant, return an empty list.\n"
-                "Examples:\n"
-                "- Relevant snippets found: {\"relevant_indices\": [0, 2, 4]}\n"
-                "- No relevant snippets: {\"relevant_indices\": []}\n"
-                "- Single relevant snippet: {\"relevant_indices\": [1]}"
-            )
-
-            user_prompt = (
-                f"Question: {query}\n\n"
-                f"Context snippets:\n{context_batch}\n\n"
-                f"Which of these snippets (by their index numbers) are relevant to answering the question? "
-                f"Be INCLUSIVE - include any snippet that could provide useful information, even if it's only partially related. "
-                f"Only exclude snippets that are completely unrelated to the topic."
+        # Identical snippets are evaluated once; the decision is applied to all copies afterwards
+        hashes = context_df['text'].map(lambda text: hashlib.blake2b(text.encode(), digest_size=8).digest())
+        is_first = ~hashes.duplicated()
+        texts = context_df['text'][is_first].tolist()
+        unique_hashes = hashes[is_first].tolist()
+
+        # Reuse earlier decisions for the same query (e.g. snippets shared by Pipelines 1 and 4)
+        normalized_query = " ".join(query.lower().split())
+        decisions = {}
+        if self.answer_cache_size:
+            for snippet_hash in unique_hashes:
+                key = (normalized_query, snippet_hash)
+                if key in self._filter_cache:
+                    self._filter_cache.move_to_end(key)
+                    decisions[snippet_hash] = self._filter_cache[key]
+        if decisions:
+            print(f"✅ Reusing {len(decisions)} cached relevance decisions")
+        pending = [position for position, snippet_hash in enumerate(unique_hashes) if snippet_hash not in decisions]
+        if pending:
+            await self._judge_snippets(
+                [texts[position] for position in pending],
+                [unique_hashes[position] for position in pending],
+                normalized_query, query, decisions
             )
 
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=0.0,
-                    messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
-                )
-
-                response_text = response.choices[0].message.content.strip()
-
-                # Parse JSON response
-                try:
-                    result = json.loads(response_text)
-                    relevant_indices = result.get('relevant_indices', [])
-
-                    # Add relevant contexts from this batch
-                    for idx in relevant_indices:
-                        if idx < len(batch):
-                            filtered_contexts.append(batch.iloc[idx])
-
-                except (json.JSONDecodeError, KeyError) as e:
-                    print(f"⚠️ Could not parse LLM response for filtering batch {i // batch_size + 1}: {e}")
-                    # If parsing fails, include all contexts from this batch as fallback
-                    filtered_contexts.extend([batch.iloc[j] for j in range(len(batch))])
-
-            except Exception as e:
-                print(f"❌ Error occurred while filtering context batch {i // batch_size + 1}: {e}")
-                # If API call fails, include all contexts from this batch as fallback
-                filtered_contexts.extend([batch.iloc[j] for j in range(len(batch))])
-
-        if filtered_contexts:
-            filtered_df = pd.DataFrame(filtered_contexts).reset_index(drop=True)
+        relevant_hashes = {h for h, is_relevant in decisions.items() if is_relevant}
+        if relevant_hashes:
+            filtered_df = context_df[hashes.isin(relevant_hashes).to_numpy()].reset_index(drop=True)
             print(f"✅ Context filtered: {len(context_df)} → {len(filtered_df)} snippets")
             return filtered_df
         else:
             print("⚠️ No relevant context found after filtering - returning original context as fallback")
             return context_df  # Return original context instead of empty DataFrame
+
+    async def _judge_snippets(self, texts: list, snippet_hashes: list, normalized_query: str, query: str,
+                              decisions: dict):
+        """
+        Runs the relevance filter over the given unique snippets and records a decision per snippet hash.
+        Successful decisions are cached if the in-memory cache is enabled; snippets of a failed
+        batch are kept, but not cached.
+        """
+        # Judge up to FILTER_BATCH_SIZE snippets per request (usually a single request); larger
+        # contexts are split into equally sized batches that are sent concurrently, and gather()
+        # returns them in batch order
+        num_batches = -(-len(texts) // FILTER_BATCH_SIZE)
+        batch_size = -(-len(texts) // num_batches)
+        offsets = range(0, len(texts), batch_size)
+        # Bound the number of requests in flight so large contexts don't trigger rate limiting
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILTER_REQUESTS)
+
+        async def filter_batch(i):
+            async with semaphore:
+                return await self._filter_batch(texts[i:i + batch_size], query, i // batch_size + 1)
+
+        batch_positions = await asyncio.gather(*[filter_batch(i) for i in offsets])
+        for i, positions in zip(offsets, batch_positions):
+            batch_hashes = snippet_hashes[i:i + batch_size]
+            if positions is None:
+                # If the API call fails, include all contexts from this batch as fallback
+                decisions.update(dict.fromkeys(batch_hashes, True))
+                continue
+            relevant = set(positions)
+            for position, snippet_hash in enumerate(batch_hashes):
+                decisions[snippet_hash] = position in relevant
+                if self.answer_cache_size:
+                    self._filter_cache[(normalized_query, snippet_hash)] = position in relevant
+        while len(self._filter_cache) > FILTER_CACHE_SIZE:
+            self._filter_cache.popitem(last=False)
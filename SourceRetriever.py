@@ -1,7 +1,35 @@
+import functools
+import re
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
-from dotenv import dotenv_values
+from config import get_config
 from elasticsearch import Elasticsearch
 
+try:
+    # orjson decodes the (large) search responses several times faster than the stdlib json module
+    import orjson
+    from elasticsearch.serializer import JSONSerializer
+
+    class _OrjsonSerializer(JSONSerializer):
+        """JSON serializer for the ES client that decodes responses with orjson."""
+
+        def loads(self, s):
+            # Empty bodies (HEAD/204 responses) decode to None, like the default JSONSerializer
+            if not s:
+                return None
+            return orjson.loads(s)
+
+    # Responses come back as plain or (ES 8) versioned JSON; both are decoded with orjson
+    _ES_SERIALIZERS = {
+        "application/json": _OrjsonSerializer(),
+        "application/vnd.elasticsearch+json": _OrjsonSerializer(),
+    }
+except ImportError:
+    _ES_SERIALIZERS = None
+
 # --- Adjust Pandas display options ---
 # Ensures that the entire text in the columns is displayed.
 pd.set_option('display.max_colwidth', None)
@@ -12,23 +40,106 @@ pd.set_option('display.width', None)
 
 
 # --- Configuration ---
-# Loads environment variables from the .env file.
 # Make sure your .env file contains the ES_API_KEY.
-config = dotenv_values(".env")
-ES_API_KEY = config.get("ES_API_KEY")
 
 # Connection parameters from your provided notebook.
 ES_HOST = "https://elasticsearch.bw.webis.de:9200"
 INDEX_NAME_SERPS = "aql_serps"
 INDEX_NAME_RESULTS = "aql_results"
 
+# Maximum number of retrieved contexts kept in the in-process cache,
+# opt-in via SourceRetriever(..., context_cache_size=CONTEXT_CACHE_SIZE).
+CONTEXT_CACHE_SIZE = 2048
+
+_TOKEN_RE = re.compile(r"\w+")
+# Dimension of the hashed term-frequency vectors used for snippet similarity.
+EMBEDDING_DIM = 4096
+# Only the best-scored snippets are considered for near-duplicate removal and MMR (pairwise cost is quadratic).
+DIVERSIFY_MAX_CANDIDATES = 300
+# Token budget for the context passed on to the answerer.
+CONTEXT_TOKEN_BUDGET = 6000
+# Snippets with at most this many characters carry too little information and are filtered out in Elasticsearch.
+MIN_SNIPPET_LENGTH = 100
+
+
+def _normalize_query(query: str) -> str:
+    """Normalizes a query for use as a cache key (whitespace-collapsed)."""
+    return " ".join(query.split())
+
+
+def _bag_of_words_key(query: str) -> str:
+    """
+    Normalizes a multi_match (OR) query for use as a cache key. Matching and scoring
+    neither depend on case nor on term order, so both are normalized away.
+    """
+    return " ".join(sorted(query.lower().split()))
+
+
+def embed_texts(texts: list) -> np.ndarray:
+    """
+    Embeds texts as L2-normalized hashed term-frequency vectors.
+
+    The vectors do not depend on the other texts in the batch, so they can be computed
+    once per snippet (e.g. stored in an 'emb' column) and reused across calls.
+
+    Args:
+        texts (list): The texts to embed.
+
+    Returns:
+        np.ndarray: Matrix of shape (len(texts), EMBEDDING_DIM).
+    """
+    matrix = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for token in _TOKEN_RE.findall(text.lower()):
+            # crc32 is stable across processes, unlike hash() on str
+            matrix[row, zlib.crc32(token.encode()) % EMBEDDING_DIM] += 1.0
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix
+
+
+def text_fingerprints(texts: pd.Series) -> pd.Series:
+    """
+    Returns a 64-bit hash per text (aligned with the input index). Deduplicating on these
+    integers avoids hashing and comparing the long snippet strings over and over.
+    """
+    return pd.Series(pd.util.hash_array(texts.to_numpy(dtype=object)), index=texts.index)
+
+
+@functools.cache
+def _token_encoding():
+    """
+    Loads the tiktoken encoding on first use. Returns None if tiktoken is not installed or
+    the encoding can't be loaded (e.g. the BPE file can't be downloaded without network access).
+    """
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except Exception as e:
+        print(f"⚠️ tiktoken encoding unavailable, estimating ~4 characters per token: {e}")
+        return None
+
+
+def count_tokens(texts: list) -> list:
+    """
+    Counts the tokens of every text, with tiktoken if available and ~4 characters per token otherwise.
+    """
+    encoding = _token_encoding()
+    if encoding is not None:
+        return [len(tokens) for tokens in encoding.encode_batch(list(texts))]
+    return [len(text) // 4 + 1 for text in texts]
+
+
 class SourceRetriever:
     """
     A class for retrieving sources from Elasticsearch using advanced queries
-    and Pandas for data manipulation. This version uses an instance client for ES.
+    and Pandas for data manipulation. Retrievers for the same host and API key share one ES client.
     """
 
-    def __init__(self, host: str, api_key: str, serps_index: str, results_index: str):
+    # One Elasticsearch client (and connection pool) per (host, api_key), shared by all retrievers
+    _shared_clients = {}
+
+    def __init__(self, host: str, api_key: str, serps_index: str, results_index: str,
+                 context_cache_size: int = 0):
         """
         Initializes the retriever and establishes the connection to Elasticsearch.
 
@@ -37,19 +148,32 @@ class SourceRetriever:
             api_key (str): The API key for authentication.
             serps_index (str): The name of the SERPs index.
             results_index (str): The name of the results index.
+            context_cache_size (int): Number of retrieved contexts kept in memory (default: 0, no caching).
         """
         self.serps_index = serps_index
         self.results_index = results_index
         self.es_client = None  # Initialize client as None
+        # LRU cache of retrieved contexts, shared by all threads using this retriever (off if the size is 0)
+        self.context_cache_size = context_cache_size
+        self._context_cache = OrderedDict()
+        self._context_cache_lock = threading.Lock()
 
+        api_key = api_key or get_config().get("ES_API_KEY")
         if not api_key:
             print("❌ ES_API_KEY not found in .env file.")
             return
 
         try:
             print("Connecting to Elasticsearch...")
-            # Store the client as an instance variable
-            self.es_client = Elasticsearch(host, api_key=api_key, verify_certs=True, request_timeout=30)
+            # Reuse the pooled client of an earlier retriever, so its TCP/TLS connections are reused too
+            client_key = (host, api_key)
+            if client_key not in SourceRetriever._shared_clients:
+                SourceRetriever._shared_clients[client_key] = Elasticsearch(
+                    host, api_key=api_key, verify_certs=True, request_timeout=30,
+                    http_compress=True,  # Gzip the (large) snippet text responses
+                    serializers=_ES_SERIALIZERS
+                )
+            self.es_client = SourceRetriever._shared_clients[client_key]
             # Test connection
             self.es_client.ping()
             print("✅ Successfully connected to Elasticsearch!")
@@ -59,34 +183,82 @@ class SourceRetriever:
                 "Please make sure you are connected to the Webis VPN and your API key is correct.")
             self.es_client = None
 
-
-    def get_serps(self, rag_query: str, use_provider_priority: bool = True, top_n_providers: int = 20):
+    def _get_cached_context(self, key: tuple):
         """
-        Retrieves relevant SERPs based on the user query, with optional provider prioritization.
+        Returns a copy of the cached context for the given key, or None on a cache miss.
+        """
+        if not self.context_cache_size:
+            return None
+        with self._context_cache_lock:
+            context = self._context_cache.get(key)
+            if context is None:
+                return None
+            self._context_cache.move_to_end(key)
+        print(f"✅ Context for '{key[1]}' served from cache.")
+        return context.copy()
+
+    def _cache_context(self, key: tuple, context: pd.DataFrame):
+        """
+        Stores a copy of the context in the cache, evicting the least recently used entry if full.
+        """
+        if not self.context_cache_size:
+            return
+        with self._context_cache_lock:
+            self._context_cache[key] = context.copy()
+            self._context_cache.move_to_end(key)
+            if len(self._context_cache) > self.context_cache_size:
+                self._context_cache.popitem(last=False)
 
-        Args:
-            rag_query (str): The user query string.
-            use_provider_priority (bool): Whether to prioritize top providers (default: True).
-            top_n_providers (int): Number of top providers to prioritize (default: 5).
+    def _match_query(self, rag_query: str, fields: list, and_operator: bool = False):
+        """
+        Builds the full-text clause for a query: multi_match (any term) by default, or
+        query_string with default_operator AND (all terms) if and_operator is set.
+        """
+        if and_operator:
+            return {
+                "query_string": {
+                    "query": rag_query,
+                    "fields": fields,
+                    "default_operator": "AND"
+                }
+            }
+        return {
+            "multi_match": {
+                "query": rag_query,
+                "fields": fields
+            }
+        }
 
-        Returns:
-            pd.DataFrame: DataFrame containing SERPs.
+    def _domain_agg_query(self, rag_query: str, top_n_providers: int = 20, and_operator: bool = False):
         """
-        if not self.es_client:
-            print("SERPs cannot be retrieved, Elasticsearch client is not connected.")
-            return pd.DataFrame()
+        Builds the aggregation query that finds the most frequent provider domains for a query.
+        """
+        return {
+            "size": 0,  # We don't need the actual results, only aggregations
+            "track_total_hits": False,
+            "query": self._match_query(rag_query, ["warc_query", "url_query"], and_operator),
+            "aggs": {
+                "domain_counts": {
+                    "terms": {
+                        "field": "provider.domain",  # Field containing domain names
+                        "size": top_n_providers,     # Number of top domains to return
+                        "order": {
+                            "_count": "desc"          # Sort by frequency (descending)
+                        }
+                    }
+                }
+            }
+        }
 
-        # Base query structure
+    def _serps_query(self, rag_query: str, top_domains: list = None, and_operator: bool = False):
+        """
+        Builds the SERPs query, boosting the given provider domains if any.
+        """
         base_query = {
             "query": {
                 "bool": {
                     "must": [
-                        {
-                            "multi_match": {
-                                "query": rag_query,
-                                "fields": ["warc_query"]
-                            }
-                        },
+                        self._match_query(rag_query, ["warc_query"], and_operator),
                         {
                             "nested": {
                                 "path": "warc_snippets",
@@ -100,76 +272,190 @@ class SourceRetriever:
                     ]
                 }
             },
+            "_source": ["warc_query", "provider.domain"],  # Only the fields used by the context
+            "track_total_hits": False,
             "size": 50
         }
 
-        # If provider priority is enabled, enhance the query
-        if use_provider_priority:
-            try:
-                # First, get domain counts using aggregation
-                domain_agg_query = {
-                    "size": 0,  # We don't need the actual results, only aggregations
-                    "query": {
-                        "multi_match": {
-                            "query": rag_query,
-                            "fields": ["warc_query", "url_query"]
-                        }
-                    },
-                    "aggs": {
-                        "domain_counts": {
-                            "terms": {
-                                "field": "provider.domain",  # Field containing domain names
-                                "size": top_n_providers,     # Number of top domains to return
-                                "order": {
-                                    "_count": "desc"          # Sort by frequency (descending)
-                                }
-                            }
-                        }
+        if top_domains:
+            # Add provider boosting to the base query
+            base_query["query"]["bool"]["should"] = [
+                {
+                    "terms": {
+                        "provider.domain": top_domains,
+                        "boost": 2.0
                     }
                 }
+            ]
+        return base_query
 
-                # Execute domain aggregation query
-                domain_response = self.es_client.search(index=self.serps_index, body=domain_agg_query)
-                domain_data = domain_response["aggregations"]["domain_counts"]["buckets"]
-
-                if domain_data:  # If we have domain data, enhance the query
-                    top_domains = [bucket["key"] for bucket in domain_data]
-
-                    # Add provider boosting to the base query
-                    base_query["query"]["bool"]["should"] = [
+    def _texts_query(self, serps_df: pd.DataFrame):
+        """
+        Builds the query that fetches the snippet texts of the given SERPs.
+        Short snippets are filtered out in Elasticsearch, and only the fields used by the context are returned.
+        """
+        return {
+            "runtime_mappings": {
+                "snippet_text_length": {
+                    "type": "long",
+                    "script": {
+                        "source": "def snippet = params['_source']['snippet']; "
+                                  "if (snippet != null && snippet['text'] != null) { emit(snippet['text'].length()); }"
+                    }
+                }
+            },
+            "query": {
+                "bool": {
+                    "must": [
                         {
                             "terms": {
-                                "provider.domain": top_domains,
-                                "boost": 2.0
+                                "serp.id": serps_df["_id"].to_list()
+                                # Query multiple IDs at the same time for efficiency
+                            },
+                        },
+                        {
+                            "exists": {
+                                "field": "snippet.text"  # Only results that have parsed texts
+                            }
+                        },
+                        {
+                            "range": {
+                                "snippet_text_length": {"gt": MIN_SNIPPET_LENGTH}
                             }
                         }
                     ]
+                }
+            },
+            "_source": ["serp.id", "snippet.id", "snippet.text", "snippet.rank"],
+            "track_total_hits": False,
+            "size": 10_000  # Set to maximum, to make sure we get all results
+        }
 
-            except Exception as e:
-                print(f"Warning: Could not retrieve domain counts, falling back to standard query: {e}")
-                # Continue with base query without provider priority
+    def _serps_to_df(self, serps: dict):
+        """
+        Converts a SERPs search response into a DataFrame.
+        """
+        hits = serps['hits']['hits']
+        sources = [hit.get('_source', {}) for hit in hits]
+        columns = {
+            "_id": [hit['_id'] for hit in hits],
+            "_source.warc_query": [source.get('warc_query') for source in sources],
+            "_score": [hit.get('_score') for hit in hits],
+        }
+        # Include provider domain in the result if available
+        domains = [source.get('provider', {}).get('domain') for source in sources]
+        if any(domain is not None for domain in domains):
+            columns["_source.provider.domain"] = domains
+        return pd.DataFrame(columns)
 
-        try:
-            serps = self.es_client.search(index=self.serps_index, body=base_query)
+    def _texts_to_df(self, texts: dict):
+        """
+        Converts a snippet texts search response into a DataFrame.
+        """
+        if not texts['hits']['hits']:
+            print("Warning: No texts found for the provided SERP IDs")
+            return pd.DataFrame()
 
-            # Include provider domain in the result if available
-            columns = ["_id", "_source.warc_query", "_score"]
-            try:
-                # Try to include provider domain if it exists in the results
-                serps_df = pd.json_normalize(serps['hits']['hits'])
-                if "_source.provider.domain" in serps_df.columns:
-                    columns.append("_source.provider.domain")
-                serps_df = serps_df.loc[:, columns]
-            except (KeyError, IndexError):
-                # Fallback to basic columns if provider domain is not available
-                serps_df = pd.json_normalize(serps['hits']['hits']).loc[:, ["_id", "_source.warc_query", "_score"]]
+        # Build the four needed columns in one pass instead of normalizing every field of every hit
+        serp_ids, snippet_ids, snippet_texts, snippet_ranks = [], [], [], []
+        for hit in texts['hits']['hits']:
+            source = hit.get('_source', {})
+            snippet = source.get('snippet', {})
+            serp_ids.append(source.get('serp', {}).get('id'))
+            snippet_ids.append(snippet.get('id'))
+            snippet_texts.append(snippet.get('text'))
+            snippet_ranks.append(snippet.get('rank'))
+
+        return pd.DataFrame({
+            "_source.serp.id": serp_ids,
+            "_source.snippet.id": snippet_ids,
+            "_source.snippet.text": snippet_texts,
+            "_source.snippet.rank": snippet_ranks,
+        })
+
+    def _merge_context(self, serps: pd.DataFrame, texts: pd.DataFrame):
+        """
+        Merges SERPs and snippet texts into the final context DataFrame.
+        """
+        if serps.empty or texts.empty:
+            return pd.DataFrame()
+
+        serps = serps.set_index("_id")
+        texts = texts[texts["_source.serp.id"].isin(serps.index)]
+        serp_ids = texts["_source.serp.id"]
+
+        # SERP ids are unique, so every snippet looks up the metadata of its SERP with map() instead of a merge.
+        # Query and provider domain repeat for all snippets of a SERP and are stored as categoricals.
+        context = pd.DataFrame({
+            "query": serp_ids.map(serps["_source.warc_query"]).astype("category"),
+            "score": serp_ids.map(serps["_score"]),
+            "text": texts["_source.snippet.text"],
+            "rank": texts["_source.snippet.rank"],
+        })
+
+        # Include the provider domain if it is available in serps
+        final_columns = ["query", "score", "text"]
+        if "_source.provider.domain" in serps.columns:
+            context["provider_domain"] = serp_ids.map(serps["_source.provider.domain"]).astype("category")
+            final_columns = ["query", "provider_domain", "score", "text"]
+
+        return (
+            context
+            .sort_values(["score", "rank"], ascending=[False, True])
+            .loc[:, final_columns]
+            .reset_index(drop=True)
+        )
+
+    def get_serps(self, rag_query: str, use_provider_priority: bool = True, top_n_providers: int = 20):
+        """
+        Retrieves relevant SERPs based on the user query, with optional provider prioritization.
+
+        Args:
+            rag_query (str): The user query string.
+            use_provider_priority (bool): Whether to prioritize top providers (default: True).
+            top_n_providers (int): Number of top providers to prioritize (default: 5).
+
+        Returns:
+            pd.DataFrame: DataFrame containing SERPs.
+        """
+        if not self.es_client:
+            print("SERPs cannot be retrieved, Elasticsearch client is not connected.")
+            return pd.DataFrame()
 
-            return serps_df
+        try:
+            return self._fetch_serps(rag_query, use_provider_priority, top_n_providers)[0]
 
         except Exception as e:
             print(f"Error retrieving SERPs: {e}")
             return pd.DataFrame()
 
+    def _fetch_serps(self, rag_query: str, use_provider_priority: bool = True, top_n_providers: int = 20):
+        """
+        Runs the (optional) domain aggregation and the SERPs search. Errors of the SERPs search are raised.
+        Returns the SERPs DataFrame and whether the provider priority could be applied as requested.
+        """
+        top_domains = None
+        complete = True
+
+        # If provider priority is enabled, enhance the query
+        if use_provider_priority:
+            try:
+                # First, get domain counts using aggregation
+                domain_response = self.es_client.search(
+                    index=self.serps_index, body=self._domain_agg_query(rag_query, top_n_providers),
+                    request_cache=True
+                )
+                domain_data = domain_response["aggregations"]["domain_counts"]["buckets"]
+                top_domains = [bucket["key"] for bucket in domain_data]
+
+            except Exception as e:
+                print(f"Warning: Could not retrieve domain counts, falling back to standard query: {e}")
+                # Continue with base query without provider priority
+                complete = False
+
+        serps = self.es_client.search(index=self.serps_index, body=self._serps_query(rag_query, top_domains))
+        return self._serps_to_df(serps), complete
+
     def get_texts_from_index(self, serps_df: pd.DataFrame):
         """
         Retrieves the snippet texts for the given SERPs DataFrame.
@@ -184,55 +470,20 @@ class SourceRetriever:
             print("Warning: No SERPs provided to get_texts_from_index")
             return pd.DataFrame()
 
-        query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "terms": {
-                                "serp.id": serps_df["_id"].values.tolist()
-                                # Query multiple IDs at the same time for efficiency
-                            },
-                        },
-                        {
-                            "exists": {
-                                "field": "snippet.text"  # Only results that have parsed texts
-                            }
-                        }
-                    ]
-                }
-            },
-            "size": 10_000  # Set to maximum, to make sure we get all results
-        }
-
         try:
-            texts = self.es_client.search(index=self.results_index, body=query)
-
-            if not texts['hits']['hits']:
-                print("Warning: No texts found for the provided SERP IDs")
-                return pd.DataFrame()
-
-            # Normalize the JSON response
-            texts_df = pd.json_normalize(texts['hits']['hits'])
-
-            # Check if the required columns exist
-            required_columns = ["_source.serp.id", "_source.snippet.id", "_source.snippet.text", "_source.snippet.rank"]
-            available_columns = texts_df.columns.tolist()
-
-            missing_columns = [col for col in required_columns if col not in available_columns]
-            if missing_columns:
-                print(f"Warning: Missing columns in texts response: {missing_columns}")
-                print(f"Available columns: {available_columns}")
-                return pd.DataFrame()
-
-            # Select only the required columns
-            texts_df = texts_df.loc[:, required_columns]
-            return texts_df
+            return self._fetch_texts(serps_df)
 
         except Exception as e:
             print(f"Error in get_texts_from_index: {e}")
             return pd.DataFrame()
 
+    def _fetch_texts(self, serps_df: pd.DataFrame):
+        """
+        Runs the snippet texts search for the given SERPs. Errors are raised.
+        """
+        texts = self.es_client.search(index=self.results_index, body=self._texts_query(serps_df))
+        return self._texts_to_df(texts)
+
     def get_context(self, rag_query: str, use_provider_priority: bool = True):
         """
         Public main method to retrieve, merge, and process data
@@ -249,53 +500,125 @@ class SourceRetriever:
             print("Context cannot be retrieved, Elasticsearch client is not connected.")
             return pd.DataFrame()
 
-        # Call get_serps with provider priority option
-        serps = self.get_serps(rag_query, use_provider_priority=use_provider_priority)
-        texts = self.get_texts_from_index(serps)
-
-        # Check if provider domain is available in serps
-        has_provider_domain = "_source.provider.domain" in serps.columns
-
-        context = (
-            pd.merge(
-                serps,
-                texts,
-                left_on="_id",
-                right_on="_source.serp.id",
-                how="inner"
-            )
-            .drop("_id", axis=1)
-        )
+        cache_key = ("or", _bag_of_words_key(rag_query), use_provider_priority)
+        cached_context = self._get_cached_context(cache_key)
+        if cached_context is not None:
+            return cached_context
 
-        # Define rename dictionary based on available columns
-        rename_dict = {
-            "_source.warc_query": "query",
-            "_score": "score",
-            "_source.serp.id": "serp_id",
-            "_source.snippet.id": "snippet_id",
-            "_source.snippet.text": "text",
-            "_source.snippet.rank": "rank",
-        }
+        try:
+            serps, complete = self._fetch_serps(rag_query, use_provider_priority)
+            texts = self._fetch_texts(serps) if not serps.empty else pd.DataFrame()
+        except Exception as e:
+            print(f"Error retrieving context for '{rag_query}': {e}")
+            return pd.DataFrame()
 
-        if has_provider_domain:
-            rename_dict["_source.provider.domain"] = "provider_domain"
+        context = self._merge_context(serps, texts)
+        # Only complete retrievals are cached, so a transient error doesn't stick to the query
+        if complete:
+            self._cache_context(cache_key, context)
+        return context
 
-        context = context.rename(rename_dict, axis=1)
+    def get_contexts_bulk(self, queries: list, use_provider_priority: bool = True, top_n_providers: int = 20,
+                          and_operator: bool = False):
+        """
+        Retrieves the context for several queries at once. Instead of 2–3 sequential
+        searches per query, all queries share one _msearch round-trip per stage
+        (domain aggregation, SERPs, texts).
 
-        # Define final columns based on what's available
-        final_columns = ["query", "text"]
-        if has_provider_domain and "provider_domain" in context.columns:
-            final_columns = ["query", "provider_domain", "text"]
+        Args:
+            queries (list): The query strings.
+            use_provider_priority (bool): Whether to use provider prioritization (default: True).
+            top_n_providers (int): Number of top providers to prioritize (default: 20).
+            and_operator (bool): Whether all query terms must match (query_string with
+                default_operator AND) instead of any of them (default: False).
 
-        context = (
-            context
-            .sort_values(["score", "rank"], ascending=[False, True])
-            .assign(length=lambda df: df["text"].apply(len))
-            .query("length > 100")  # This can also be done in Elastic directly – try to figure out how!
-            .loc[:, final_columns]
-            .reset_index(drop=True)
-        )
-        return context
+        Returns:
+            list: One context DataFrame per query, in the same order as the queries.
+        """
+        if not self.es_client:
+            print("Context cannot be retrieved, Elasticsearch client is not connected.")
+            return [pd.DataFrame() for _ in queries]
+
+        contexts = [None] * len(queries)
+        if and_operator:
+            # Not lowercased: query_string treats upper-case AND/OR/NOT as operators
+            cache_keys = [("and", _normalize_query(q), use_provider_priority) for q in queries]
+        else:
+            cache_keys = [("or", _bag_of_words_key(q), use_provider_priority) for q in queries]
+        for i, cache_key in enumerate(cache_keys):
+            contexts[i] = self._get_cached_context(cache_key)
+
+        # Every distinct uncached query is searched once, duplicates share the result
+        pending = {}
+        for i, cache_key in enumerate(cache_keys):
+            if contexts[i] is None:
+                pending.setdefault(cache_key, []).append(i)
+        if not pending:
+            return contexts
+
+        pending_queries = [queries[positions[0]] for positions in pending.values()]
+        print(f"\n--- Retrieving context for {len(pending_queries)} queries with _msearch ---")
+
+        top_domains = [None] * len(pending_queries)
+        # Queries with a failed search (or a missing provider boost) are returned, but not cached
+        failed = [False] * len(pending_queries)
+        if use_provider_priority:
+            try:
+                searches = []
+                for q in pending_queries:
+                    searches.extend([
+                        # Aggregation-only (size 0) searches can be answered from the shard request cache
+                        {"index": self.serps_index, "request_cache": True},
+                        self._domain_agg_query(q, top_n_providers, and_operator)
+                    ])
+                responses = self.es_client.msearch(body=searches)["responses"]
+                top_domains = [
+                    [bucket["key"] for bucket in r["aggregations"]["domain_counts"]["buckets"]]
+                    if "error" not in r else None
+                    for r in responses
+                ]
+                failed = ["error" in r for r in responses]
+            except Exception as e:
+                print(f"Warning: Could not retrieve domain counts, falling back to standard query: {e}")
+                failed = [True] * len(pending_queries)
+
+        try:
+            searches = []
+            for q, domains in zip(pending_queries, top_domains):
+                searches.extend([{"index": self.serps_index}, self._serps_query(q, domains, and_operator)])
+            responses = self.es_client.msearch(body=searches)["responses"]
+            serps_dfs = [self._serps_to_df(r) if "error" not in r else pd.DataFrame() for r in responses]
+            failed = [was_failed or "error" in r for was_failed, r in zip(failed, responses)]
+
+            searches = []
+            for serps_df in serps_dfs:
+                if not serps_df.empty:
+                    searches.extend([{"index": self.results_index}, self._texts_query(serps_df)])
+            responses = iter(self.es_client.msearch(body=searches)["responses"] if searches else [])
+            texts_dfs = []
+            for position, serps_df in enumerate(serps_dfs):
+                if serps_df.empty:
+                    texts_dfs.append(pd.DataFrame())
+                    continue
+                response = next(responses)
+                texts_dfs.append(self._texts_to_df(response) if "error" not in response else pd.DataFrame())
+                failed[position] = failed[position] or "error" in response
+        except Exception as e:
+            print(f"Error in get_contexts_bulk: {e}")
+            for positions in pending.values():
+                for i in positions:
+                    contexts[i] = pd.DataFrame()
+            return contexts
+
+        for (cache_key, positions), serps_df, texts_df, was_failed in zip(pending.items(), serps_dfs, texts_dfs, failed):
+            context = self._merge_context(serps_df, texts_df)
+            if not was_failed:
+                self._cache_context(cache_key, context)
+            for i in positions:
+                contexts[i] = context.copy()
+
+        print(f"✅ Retrieved context for {len(pending_queries)} queries")
+        return contexts
 
     def get_context_pipeline4(self, query_list: list, use_provider_priority: bool = True):
         """
@@ -319,37 +642,43 @@ class SourceRetriever:
 
         print(f"\n--- Starting Pipeline 4 with {len(query_list)} queries ---")
 
-        all_contexts = []
-
-        for i, space_query in enumerate(query_list):
-            print(f"Query {i+1}: '{space_query}' -> Elasticsearch with default_operator AND")
-
-            # Get context for this space-separated query using default_operator AND
-            context = self.get_serps_with_and_query(space_query, use_provider_priority)
-            
-            if context.empty:
-                print(f"  ⚠️ No results found with AND, retrying with OR")
-                context = self.get_context(space_query, use_provider_priority)
+        unique_queries = list(dict.fromkeys(_normalize_query(q) for q in query_list))
+        if len(unique_queries) < len(query_list):
+            print(f"Skipping {len(query_list) - len(unique_queries)} duplicate queries")
 
+        # All queries are searched with default_operator AND in one _msearch round-trip per stage;
+        # the ones without results are retried together with OR
+        contexts = self.get_contexts_bulk(unique_queries, use_provider_priority, and_operator=True)
+        empty = [i for i, context in enumerate(contexts) if context.empty]
+        if empty:
+            print(f"  ⚠️ No results found with AND for {len(empty)} queries, retrying with OR")
+            for i, context in zip(empty, self.get_contexts_bulk([unique_queries[i] for i in empty],
+                                                                 use_provider_priority)):
+                contexts[i] = context
 
+        all_contexts = []
+        seen_fingerprints = set()
+        for i, (space_query, context) in enumerate(zip(unique_queries, contexts)):
             if not context.empty:
+                found = len(context)
+                # Only keep texts not seen for an earlier query, so the first source query wins
+                fingerprints = text_fingerprints(context['text'])
+                is_new = ~fingerprints.duplicated() & ~fingerprints.isin(seen_fingerprints)
+                seen_fingerprints.update(fingerprints[is_new])
                 # Add query information for tracking
-                context['source_query'] = space_query
+                context = context[is_new].assign(source_query=space_query)
                 all_contexts.append(context)
-                print(f"  ✅ Found {len(context)} results")
+                print(f"Query {i+1}: '{space_query}' ✅ Found {found} results ({len(context)} new)")
             else:
-                print(f"  ⚠️ No results found")
+                print(f"Query {i+1}: '{space_query}' ⚠️ No results found")
 
         if all_contexts:
-            # Combine all contexts and remove duplicates based on text
+            # Combine all contexts (already free of duplicate texts)
             combined_context = pd.concat(all_contexts, ignore_index=True)
 
-            # Remove duplicate texts while keeping track of source queries
-            combined_context = combined_context.drop_duplicates(subset=['text'], keep='first')
-
             # Sort by score if available
             if 'score' in combined_context.columns:
-                combined_context = combined_context.sort_values('score', ascending=False)
+                combined_context = combined_context.sort_values('score', ascending=False, kind='stable')
 
             combined_context = combined_context.reset_index(drop=True)
             print(f"✅ Pipeline 4 completed: {len(combined_context)} unique results from {len(query_list)} queries")
@@ -373,142 +702,90 @@ class SourceRetriever:
         if not self.es_client:
             return pd.DataFrame()
 
-        # Base query structure using default_operator AND
-        base_query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "query_string": {
-                                "query": query,
-                                "fields": ["warc_query"],
-                                "default_operator": "AND"
-                            }
-                        },
-                        {
-                            "nested": {
-                                "path": "warc_snippets",
-                                "query": {
-                                    "exists": {
-                                        "field": "warc_snippets.id"
-                                    }
-                                }
-                            }
-                        }
-                    ]
-                }
-            },
-            "size": 50
-        }
-
-        # Add provider priority if enabled
-        if use_provider_priority:
-            try:
-                # Get domain counts using aggregation
-                domain_agg_query = {
-                    "size": 0,
-                    "query": {
-                        "query_string": {
-                            "query": query,
-                            "fields": ["warc_query", "url_query"],
-                            "default_operator": "AND"
-                        }
-                    },
-                    "aggs": {
-                        "domain_counts": {
-                            "terms": {
-                                "field": "provider.domain",
-                                "size": 20,
-                                "order": {
-                                    "_count": "desc"
-                                }
-                            }
-                        }
-                    }
-                }
-
-                domain_response = self.es_client.search(index=self.serps_index, body=domain_agg_query)
-                domain_data = domain_response["aggregations"]["domain_counts"]["buckets"]
-
-                if domain_data:
-                    top_domains = [bucket["key"] for bucket in domain_data]
-                    base_query["query"]["bool"]["should"] = [
-                        {
-                            "terms": {
-                                "provider.domain": top_domains,
-                                "boost": 2.0
-                            }
-                        }
-                    ]
+        return self.get_contexts_bulk([query], use_provider_priority, and_operator=True)[0]
 
-            except Exception as e:
-                print(f"Warning: Could not retrieve domain counts for AND query, using standard query: {e}")
-
-        try:
-            # Get SERPs using query_string with default_operator AND
-            serps_response = self.es_client.search(index=self.serps_index, body=base_query)
-
-            if not serps_response['hits']['hits']:
-                return pd.DataFrame()
+    def diversify_context(self, context_df: pd.DataFrame, query: str, top_k: int = 20,
+                          duplicate_threshold: float = 0.92, mmr_lambda: float = 0.5,
+                          max_candidates: int = DIVERSIFY_MAX_CANDIDATES):
+        """
+        Removes near-duplicate snippets and selects a diverse, query-relevant subset
+        using Maximal Marginal Relevance (MMR). Only the max_candidates best-scored
+        snippets are considered, since the pairwise similarities grow quadratically.
 
-            # Process SERP results
-            columns = ["_id", "_source.warc_query", "_score"]
-            try:
-                serps_df = pd.json_normalize(serps_response['hits']['hits'])
-                if "_source.provider.domain" in serps_df.columns:
-                    columns.append("_source.provider.domain")
-                serps_df = serps_df.loc[:, columns]
-            except (KeyError, IndexError):
-                serps_df = pd.json_normalize(serps_response['hits']['hits']).loc[:, ["_id", "_source.warc_query", "_score"]]
-
-            # Get texts for these SERPs
-            texts_df = self.get_texts_from_index(serps_df)
-
-            if texts_df.empty:
-                return pd.DataFrame()
-
-            # Merge and process
-            has_provider_domain = "_source.provider.domain" in serps_df.columns
-
-            context = pd.merge(
-                serps_df,
-                texts_df,
-                left_on="_id",
-                right_on="_source.serp.id",
-                how="inner"
-            ).drop("_id", axis=1)
-
-            # Rename columns
-            rename_dict = {
-                "_source.warc_query": "query",
-                "_score": "score",
-                "_source.serp.id": "serp_id",
-                "_source.snippet.id": "snippet_id",
-                "_source.snippet.text": "text",
-                "_source.snippet.rank": "rank",
-            }
+        Snippets are represented as L2-normalized hashed term-frequency vectors, so all pairwise
+        similarities come from a single matrix product. If the DataFrame already carries an
+        'emb' column (see embed_texts), those vectors are reused instead of being recomputed.
 
-            if has_provider_domain:
-                rename_dict["_source.provider.domain"] = "provider_domain"
+        Args:
+            context_df (pd.DataFrame): Context DataFrame with a 'text' column, in retrieval order.
+            query (str): The user query the snippets should be relevant to.
+            top_k (int): Maximum number of snippets to keep (default: 20).
+            duplicate_threshold (float): Cosine similarity above which snippets count as duplicates.
+            mmr_lambda (float): Trade-off between relevance (1.0) and diversity (0.0).
+            max_candidates (int): Maximum number of snippets considered (default: DIVERSIFY_MAX_CANDIDATES).
 
-            context = context.rename(rename_dict, axis=1)
+        Returns:
+            pd.DataFrame: The selected snippets, in MMR selection order.
+        """
+        if context_df.empty:
+            return context_df
+
+        input_size = len(context_df)
+        if input_size > max_candidates:
+            # Without scores the retrieval order is the best available ranking
+            if "score" in context_df.columns:
+                context_df = context_df.sort_values("score", ascending=False, kind="stable")
+            context_df = context_df.head(max_candidates)
+
+        # Vectorize every snippet exactly once; duplicate removal and MMR share the matrix
+        if "emb" in context_df.columns:
+            matrix = np.vstack(context_df["emb"].to_numpy())
+        else:
+            matrix = embed_texts(context_df["text"].tolist())
+        query_vector = embed_texts([query])[0]
+
+        # Only a few hundred of the hashed dimensions are in use; dropping the empty ones
+        # shrinks the matrix product without changing any similarity
+        used_dims = matrix.any(axis=0)
+        matrix = np.ascontiguousarray(matrix[:, used_dims])
+        query_vector = query_vector[used_dims]
+
+        similarities = matrix @ matrix.T
+        relevance = matrix @ query_vector
+
+        # Drop every snippet that is a near-duplicate of a better-ranked one (upper triangle: j > i)
+        is_duplicate = np.triu(similarities >= duplicate_threshold, k=1).any(axis=0)
+        candidates = np.flatnonzero(~is_duplicate).tolist()
+
+        # Greedy MMR selection
+        selected = []
+        while candidates and len(selected) < top_k:
+            if selected:
+                redundancy = similarities[np.ix_(candidates, selected)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(candidates), dtype=np.float32)
+            scores = mmr_lambda * relevance[candidates] - (1 - mmr_lambda) * redundancy
+            selected.append(candidates.pop(int(np.argmax(scores))))
 
-            # Final processing
-            final_columns = ["query", "text"]
-            if has_provider_domain and "provider_domain" in context.columns:
-                final_columns = ["query", "provider_domain", "text"]
+        print(f"✅ Context diversified: {input_size} → {len(selected)} snippets")
+        return context_df.iloc[selected].drop(columns="emb", errors="ignore").reset_index(drop=True)
 
-            context = (
-                context
-                .sort_values(["score", "rank"], ascending=[False, True])
-                .assign(length=lambda df: df["text"].apply(len))
-                .query("length > 100")
-                .loc[:, final_columns]
-                .reset_index(drop=True)
-            )
+    def truncate_to_token_budget(self, context_df: pd.DataFrame, max_tokens: int = CONTEXT_TOKEN_BUDGET):
+        """
+        Keeps the leading snippets whose combined length fits into the token budget.
 
-            return context
+        Args:
+            context_df (pd.DataFrame): Context DataFrame with a 'text' column, in priority order.
+            max_tokens (int): Maximum total number of tokens (default: CONTEXT_TOKEN_BUDGET).
 
-        except Exception as e:
-            print(f"Error in AND query search: {e}")
-            return pd.DataFrame()
\ No newline at end of file
+        Returns:
+            pd.DataFrame: The longest prefix of the snippets that fits into the budget.
+        """
+        if context_df.empty:
+            return context_df
+
+        token_counts = np.cumsum(count_tokens(context_df["text"].tolist()))
+        fitting_rows = int(np.searchsorted(token_counts, max_tokens, side="right"))
+        if fitting_rows < len(context_df):
+            print(f"✅ Context truncated to {max_tokens} tokens: {len(context_df)} → {fitting_rows} snippets")
+        return context_df.iloc[:fitting_rows].reset_index(drop=True)
@@ -1,8 +1,9 @@
 import streamlit as st
 import pandas as pd
-from SourceRetriever import SourceRetriever
-from LLM import LLM
-from dotenv import dotenv_values
+from SourceRetriever import SourceRetriever, text_fingerprints, CONTEXT_CACHE_SIZE
+from LLM import LLM, CACHE_PATH, ANSWER_CACHE_SIZE
+from config import get_config
+import asyncio
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -12,18 +13,18 @@ st.set_page_config(
 )
 
 # --- Pipeline Functions ---
-def run_pipeline_1(query, retriever, llm_generator):
+async def run_pipeline_1(query, retriever, llm_generator, context_future=None):
     """Pipeline 1: Original Query (Direct Context → Filter → Answer)"""
     try:
-        context_df = retriever.get_context(query)
+        context_df = await (context_future or asyncio.to_thread(retriever.get_context, query))
         original_context = context_df.copy() if not context_df.empty else pd.DataFrame()
 
         if not context_df.empty:
             # Apply context filtering for Pipeline 1
-            filtered_context_df = llm_generator.filter_context(context_df, query)
+            filtered_context_df = await llm_generator.filter_context(context_df, query)
 
             if not filtered_context_df.empty:
-                answer = llm_generator.answer_question_from_context(filtered_context_df, query)
+                answer = await llm_generator.answer_question_from_context(filtered_context_df, query)
                 return {
                     'answer': answer or "Could not generate an answer.",
                     'original_context': original_context,
@@ -47,15 +48,15 @@ def run_pipeline_1(query, retriever, llm_generator):
             'filtered_context': pd.DataFrame()
         }
 
-def run_pipeline_2(query, retriever, llm_generator):
+async def run_pipeline_2(query, retriever, llm_generator, context_future=None):
     """Pipeline 2: Original Query (Summary → Answer)"""
     try:
-        context_df = retriever.get_context(query)
+        context_df = await (context_future or asyncio.to_thread(retriever.get_context, query))
 
         if not context_df.empty:
-            summarized_context = llm_generator.summarize_context(context_df, query)
+            summarized_context = await llm_generator.summarize_context(context_df, query)
             if summarized_context:
-                answer = llm_generator.answer_question_from_summary(summarized_context, query)
+                answer = await llm_generator.answer_question_from_summary(summarized_context, query)
                 return {
                     'answer': answer or "Could not generate an answer.",
                     'context': context_df,
@@ -73,16 +74,16 @@ def run_pipeline_2(query, retriever, llm_generator):
             'summary': ""
         }
 
-def run_pipeline_3(query, retriever, llm_generator):
+async def run_pipeline_3(query, retriever, llm_generator):
     """Pipeline 3: Rewritten Query (Rewrite → Summary → Answer)"""
     try:
-        rewritten_query = llm_generator.rewrite_query(query)
-        context_df = retriever.get_context(rewritten_query)
+        rewritten_query = await llm_generator.rewrite_query(query)
+        context_df = await asyncio.to_thread(retriever.get_context, rewritten_query)
 
         if not context_df.empty:
-            summarized_context = llm_generator.summarize_context(context_df, query)
+            summarized_context = await llm_generator.summarize_context(context_df, query)
             if summarized_context:
-                answer = llm_generator.answer_question_from_summary(summarized_context, query)
+                answer = await llm_generator.answer_question_from_summary(summarized_context, query)
                 return {
                     'answer': answer or "Could not generate an answer.",
                     'rewritten_query': rewritten_query,
@@ -103,27 +104,36 @@ def run_pipeline_3(query, retriever, llm_generator):
             'summary': ""
         }
 
-def run_pipeline_4(query, retriever, llm_generator):
+async def run_pipeline_4(query, retriever, llm_generator):
     """Pipeline 4: Query Pool (Query Pool → Filtered Context → Direct Answer)"""
     try:
-        query_pool = llm_generator.generate_query_pool(query, 4)
+        query_pool = await llm_generator.generate_query_pool(query, 4)
+        pooled_dfs = await asyncio.to_thread(retriever.get_contexts_bulk, query_pool)
+        # Keep only texts that were not retrieved for an earlier query in the pool
         all_contexts = []
-        for q in query_pool:
-            pooled_df = retriever.get_context(q)
-            if not pooled_df.empty:
-                all_contexts.append(pooled_df)
+        seen_fingerprints = set()
+        for pooled_df in pooled_dfs:
+            if pooled_df.empty:
+                continue
+            fingerprints = text_fingerprints(pooled_df['text'])
+            is_new = ~fingerprints.duplicated() & ~fingerprints.isin(seen_fingerprints)
+            if is_new.any():
+                seen_fingerprints.update(fingerprints[is_new])
+                all_contexts.append(pooled_df[is_new])
 
         if all_contexts:
-            full_context_df = pd.concat(all_contexts, ignore_index=True).drop_duplicates(
-                subset=['text']).reset_index(drop=True)
-            truncated_pool_df = full_context_df.head(100)
+            full_context_df = pd.concat(all_contexts, ignore_index=True)
+            # Drop near-duplicates, keep a diverse, query-relevant top-K and fit it into the token budget
+            # (CPU-bound, so it runs in a worker thread instead of blocking the event loop)
+            diverse_context_df = await asyncio.to_thread(retriever.diversify_context, full_context_df, query, top_k=20)
+            truncated_pool_df = retriever.truncate_to_token_budget(diverse_context_df)
             original_context = truncated_pool_df.copy()
 
             # Apply context filtering for Pipeline 4
-            filtered_context_df = llm_generator.filter_context(truncated_pool_df, query)
+            filtered_context_df = await llm_generator.filter_context(truncated_pool_df, query)
 
             if not filtered_context_df.empty:
-                answer = llm_generator.answer_question_from_context(filtered_context_df, query)
+                answer = await llm_generator.answer_question_from_context(filtered_context_df, query)
                 return {
                     'answer': answer or "Could not generate an answer.",
                     'query_pool': query_pool,
@@ -155,7 +165,7 @@ def run_pipeline_4(query, retriever, llm_generator):
 @st.cache_data
 def load_config():
     try:
-        config = dotenv_values(".env")
+        config = get_config()
         es_api_key = config.get("ES_API_KEY")
         llm_api_key = config.get("API_KEY")
         if not es_api_key or not llm_api_key:
@@ -179,7 +189,9 @@ def get_retriever():
         host="https://elasticsearch.bw.webis.de:9200",
         api_key=ES_API_KEY,
         serps_index="aql_serps",
-        results_index="aql_results"
+        results_index="aql_results",
+        # Interactive use only; app_rank retrieves uncached so its timings stay comparable
+        context_cache_size=CONTEXT_CACHE_SIZE
     )
     if not retriever.es_client:
         st.error("Failed to connect to Elasticsearch. Please check your VPN and API key.")
@@ -191,13 +203,28 @@ def get_llm_generator():
     llm = LLM(
         api_key=LLM_API_KEY,
         base_url="https://api.helmholtz-blablador.fz-juelich.de/v1/",
-        model="alias-fast-experimental"
+        model="alias-fast-experimental",
+        # Interactive use only; app_rank runs uncached and uncompressed so its timings and answers stay comparable
+        cache_path=CACHE_PATH,
+        answer_cache_size=ANSWER_CACHE_SIZE,
+        compress_context=True
     )
     if not llm.client:
         st.error("Failed to initialize the LLM client. Please check your API key.")
         return None
     return llm
 
+async def run_all_pipelines(query, retriever, llm_generator):
+    """Runs all four pipelines concurrently for the given query."""
+    # Pipelines 1 and 2 both start from the context of the original query; retrieve it only once
+    original_context = asyncio.ensure_future(asyncio.to_thread(retriever.get_context, query))
+    return await asyncio.gather(
+        run_pipeline_1(query, retriever, llm_generator, original_context),
+        run_pipeline_2(query, retriever, llm_generator, original_context),
+        run_pipeline_3(query, retriever, llm_generator),
+        run_pipeline_4(query, retriever, llm_generator)
+    )
+
 # --- Main Analysis Tool ---
 st.title("🔬 RAG Pipeline Analysis Tool")
 st.markdown(
@@ -225,11 +252,14 @@ if st.button("Run Analysis", type="primary"):
     else:
         st.success(f"Processing query: **{user_question}**")
 
+        with st.spinner("Running all pipelines..."):
+            # Runs on the LLM's background event loop, which also owns its connection pool
+            pipeline1_result, pipeline2_result, pipeline3_result, pipeline4_result = llm_generator.run(
+                run_all_pipelines(user_question, retriever, llm_generator)
+            )
+
         # --- Pipeline 1: Original Query (Direct Context → Filter → Answer) ---
         st.header("Pipeline 1: Original Query (Direct Context → Filter → Answer)")
-        with st.spinner("Running Pipeline 1..."):
-            pipeline1_result = run_pipeline_1(user_question, retriever, llm_generator)
-
         if not pipeline1_result['original_context'].empty:
             st.info(f"Retrieved **{len(pipeline1_result['original_context'])}** snippets, filtered to **{len(pipeline1_result['filtered_context'])}** relevant snippets.")
 
@@ -251,9 +281,6 @@ if st.button("Run Analysis", type="primary"):
 
         # --- Pipeline 2: Original Query (Summary → Answer) ---
         st.header("Pipeline 2: Original Query (Summary → Answer)")
-        with st.spinner("Running Pipeline 2..."):
-            pipeline2_result = run_pipeline_2(user_question, retriever, llm_generator)
-
         if not pipeline2_result['context'].empty:
             st.info(f"Retrieved **{len(pipeline2_result['context'])}** snippets for Pipeline 2.")
             with st.expander("Show Retrieved Context for Pipeline 2"):
@@ -269,9 +296,6 @@ if st.button("Run Analysis", type="primary"):
 
         # --- Pipeline 3: Rewritten Query (Rewrite → Summary → Answer) ---
         st.header("Pipeline 3: Rewritten Query (Rewrite → Summary → Answer)")
-        with st.spinner("Running Pipeline 3..."):
-            pipeline3_result = run_pipeline_3(user_question, retriever, llm_generator)
-
         st.subheader("LLM-Rewritten Query")
         st.info(f"**{pipeline3_result['rewritten_query']}**")
 
@@ -290,9 +314,6 @@ if st.button("Run Analysis", type="primary"):
 
         # --- Pipeline 4: Query Pool (Query Pool → Filtered Context → Direct Answer) ---
         st.header("Pipeline 4: Query Pool (Query Pool → Filtered Context → Direct Answer)")
-        with st.spinner("Running Pipeline 4..."):
-            pipeline4_result = run_pipeline_4(user_question, retriever, llm_generator)
-
         if pipeline4_result['query_pool']:
             st.subheader("Generated Query Pool")
             for i, query in enumerate(pipeline4_result['query_pool'], 1):
@@ -2,11 +2,12 @@ import streamlit as st
 import pandas as pd
 from SourceRetriever import SourceRetriever
 from LLM import LLM
-from dotenv import dotenv_values
+from config import get_config
 import random
 import io
 import time
 import os
+import asyncio
 from datetime import datetime
 
 # --- Page Configuration ---
@@ -20,7 +21,7 @@ st.set_page_config(
 @st.cache_data
 def load_config():
     try:
-        config = dotenv_values(".env")
+        config = get_config()
         es_api_key = config.get("ES_API_KEY")
         llm_api_key = config.get("API_KEY")
         if not es_api_key or not llm_api_key:
@@ -88,14 +89,14 @@ TEST_QUERIES = [
 ]
 
 # --- Pipeline Functions ---
-def run_pipeline_1(query, retriever, llm_generator):
+async def run_pipeline_1(query, retriever, llm_generator):
     """Pipeline 1: Original Query (Direct Context → Answer)"""
     start_time = time.time()
     try:
-        context_df = retriever.get_context(query)
+        context_df = await asyncio.to_thread(retriever.get_context, query)
 
         if not context_df.empty:
-            answer = llm_generator.answer_question_from_context(context_df, query)
+            answer = await llm_generator.answer_question_from_context(context_df, query)
             execution_time = time.time() - start_time
             return {
                 'answer': answer or "Could not generate an answer.",
@@ -118,26 +119,30 @@ def run_pipeline_1(query, retriever, llm_generator):
             'execution_time': execution_time
         }
 
-def run_pipeline_4(query, retriever, llm_generator):
+async def run_pipeline_4(query, retriever, llm_generator):
     """Pipeline 4: Query Pool with AND operators (Generate Query Pool → AND Query Context → Filter → Answer)"""
     start_time = time.time()
     try:
         # Generate query pool using LLM
-        query_pool = llm_generator.generate_query_pool(query, 10)
+        query_pool = await llm_generator.generate_query_pool(query, 10)
 
         # Use the new pipeline4 method that handles AND operators
-        full_context_df = retriever.get_context_pipeline4(query_pool, use_provider_priority=True)
+        full_context_df = await asyncio.to_thread(
+            retriever.get_context_pipeline4, query_pool, use_provider_priority=True
+        )
 
         if not full_context_df.empty:
-            # Truncate to top 100 results
-            truncated_pool_df = full_context_df.head(100)
+            # Drop near-duplicates, keep a diverse, query-relevant top-K and fit it into the token budget
+            # (CPU-bound, so it runs in a worker thread instead of blocking the event loop)
+            diverse_context_df = await asyncio.to_thread(retriever.diversify_context, full_context_df, query, top_k=20)
+            truncated_pool_df = retriever.truncate_to_token_budget(diverse_context_df)
             original_context = truncated_pool_df.copy()
 
             # Apply context filtering for Pipeline 4
-            filtered_context_df = llm_generator.filter_context(truncated_pool_df, query)
+            filtered_context_df = await llm_generator.filter_context(truncated_pool_df, query)
 
             if not filtered_context_df.empty:
-                answer = llm_generator.answer_question_from_context(filtered_context_df, query, is_pipeline_4=True)
+                answer = await llm_generator.answer_question_from_context(filtered_context_df, query, is_pipeline_4=True)
                 execution_time = time.time() - start_time
                 return {
                     'answer': answer or "Could not generate an answer.",
@@ -170,6 +175,31 @@ def run_pipeline_4(query, retriever, llm_generator):
             'execution_time': execution_time
         }
 
+async def run_comparison(query, retriever, llm_generator):
+    """Runs both pipelines for one query and randomly assigns them to the left/right side."""
+    # Pipelines run one after the other so the recorded execution times are not
+    # skewed by competing for the same LLM and Elasticsearch connections.
+    pipeline1_result = await run_pipeline_1(query, retriever, llm_generator)
+    pipeline4_result = await run_pipeline_4(query, retriever, llm_generator)
+
+    # Randomly assign which pipeline goes to left/right
+    if random.choice([True, False]):
+        left_result = ("Pipeline 1", pipeline1_result)
+        right_result = ("Pipeline 4", pipeline4_result)
+    else:
+        left_result = ("Pipeline 4", pipeline4_result)
+        right_result = ("Pipeline 1", pipeline1_result)
+
+    return {
+        'query': query,
+        'left': left_result,
+        'right': right_result,
+        'pipeline1_answer': pipeline1_result['answer'],
+        'pipeline4_answer': pipeline4_result['answer'],
+        'pipeline1_time': pipeline1_result['execution_time'],
+        'pipeline4_time': pipeline4_result['execution_time']
+    }
+
 # --- Initialize Session State ---
 if 'results_ready' not in st.session_state:
     st.session_state.results_ready = False
@@ -244,31 +274,11 @@ if not st.session_state.results_ready:
         progress_bar = st.progress(0)
         status_text = st.empty()
 
+        # Queries are processed sequentially so the timing comparison stays fair
         for i, query in enumerate(TEST_QUERIES):
             status_text.text(f"Processing query {i+1}/{len(TEST_QUERIES)}: {query}")
-
-            # Run both pipelines
-            pipeline1_result = run_pipeline_1(query, retriever, llm_generator)
-            pipeline4_result = run_pipeline_4(query, retriever, llm_generator)
-
-            # Randomly assign which pipeline goes to left/right
-            if random.choice([True, False]):
-                left_result = ("Pipeline 1", pipeline1_result)
-                right_result = ("Pipeline 4", pipeline4_result)
-            else:
-                left_result = ("Pipeline 4", pipeline4_result)
-                right_result = ("Pipeline 1", pipeline1_result)
-
-            st.session_state.comparison_results.append({
-                'query': query,
-                'left': left_result,
-                'right': right_result,
-                'pipeline1_answer': pipeline1_result['answer'],
-                'pipeline4_answer': pipeline4_result['answer'],
-                'pipeline1_time': pipeline1_result['execution_time'],
-                'pipeline4_time': pipeline4_result['execution_time']
-            })
-
+            result = llm_generator.run(run_comparison(query, retriever, llm_generator))
+            st.session_state.comparison_results.append(result)
             progress_bar.progress((i + 1) / len(TEST_QUERIES))
 
         status_text.text("✅ All queries processed! Ready for voting.")
@@ -358,9 +368,9 @@ elif st.session_state.results_ready and not st.session_state.voting_complete:
 
                 # Display context snippets
                 with st.expander(f"View {selected_context} snippets", expanded=True):
-                    for idx, row in selected_df.iterrows():
+                    for idx, text in zip(selected_df.index, selected_df['text']):
                         st.markdown(f"**Snippet {idx + 1}:**")
-                        st.text(row['text'])
+                        st.text(text)
                         st.markdown("---")
         else:
             st.info("No context available for this query.")
@@ -0,0 +1,15 @@
+import functools
+from dotenv import dotenv_values
+
+# --- Configuration ---
+# Loads environment variables from the .env file.
+# Make sure your .env file contains the API_KEY for the LLM and the ES_API_KEY for Elasticsearch.
+
+
+@functools.cache
+def get_config() -> dict:
+    """
+    Loads the environment variables from the .env file once, on first use.
+    Shared by all modules, so the file is parsed only once per process.
+    """
+    return dotenv_values(".env")